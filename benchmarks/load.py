@@ -0,0 +1,175 @@
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+import requests
+from prometheus_client.parser import text_string_to_metric_families
+
+from run import BENCHMARKS_DIR, SCENARIOS, git_commit, percentile, send, start_api, upstream_env, wait_until_ready
+
+
+def parse_mix(value):
+    """
+    'geosparql=8,csv=1' -> {"geosparql": 8.0, "csv": 1.0}
+    """
+    mix = {}
+    for item in value.split(","):
+        scenario, _, weight = item.partition("=")
+        if scenario not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"unknown scenario '{scenario}', use one of: {', '.join(SCENARIOS)}")
+        mix[scenario] = float(weight or 1)
+    return mix
+
+def event_loop_lag(api_url):
+    """
+    Cumulative buckets, sum and count of the API event loop lag histogram.
+    """
+    text = requests.get(api_url + "/metrics", timeout=10).text
+    lag = {"buckets": {}, "sum": 0.0, "count": 0.0}
+    for family in text_string_to_metric_families(text):
+        if family.name != "geosparql_event_loop_lag_seconds":
+            continue
+        for sample in family.samples:
+            if sample.name.endswith("_bucket"):
+                lag["buckets"][float(sample.labels["le"])] = sample.value
+            elif sample.name.endswith("_sum"):
+                lag["sum"] = sample.value
+            elif sample.name.endswith("_count"):
+                lag["count"] = sample.value
+    return lag
+
+def lag_between(before, after):
+    count = after["count"] - before["count"]
+    if not count:
+        return {"mean_s": None, "p99_s": None}
+    p99 = next(
+        bound for bound, cumulative in sorted(after["buckets"].items())
+        if cumulative - before["buckets"].get(bound, 0) >= 0.99 * count
+    )
+    return {"mean_s": round((after["sum"] - before["sum"]) / count, 4), "p99_s": p99}
+
+def run_step(api_url, concurrency, duration, mix, timeout, seed):
+    """
+    `concurrency` closed-loop clients send requests picked from the mix until `duration` seconds have passed.
+    """
+    results = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+    scenarios, weights = list(mix), list(mix.values())
+
+    def client(index):
+        rng = random.Random(seed * 1000 + index)
+        while time.perf_counter() < deadline:
+            scenario = rng.choices(scenarios, weights)[0]
+            start = time.perf_counter()
+            try:
+                _, status, _ = send(api_url, scenario, timeout)
+            except requests.RequestException:
+                status = None
+            with lock:
+                results.append((scenario, time.perf_counter() - start, status))
+
+    lag_before = event_loop_lag(api_url)
+    start = time.perf_counter()
+    clients = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    lag = lag_between(lag_before, event_loop_lag(api_url))
+
+    latencies = [latency for _, latency, _ in results]
+    errors = sum(status != 200 for _, _, status in results)
+    return {
+        "concurrency": concurrency,
+        "requests": len(results),
+        "throughput_rps": round(len(results) / elapsed, 2),
+        "p50_s": round(percentile(latencies, 50), 4) if results else None,
+        "p95_s": round(percentile(latencies, 95), 4) if results else None,
+        "p99_s": round(percentile(latencies, 99), 4) if results else None,
+        "error_rate": round(errors / len(results), 4) if results else None,
+        "event_loop_lag": lag,
+        "by_scenario": {
+            scenario: sum(1 for name, _, _ in results if name == scenario) for scenario in mix
+        },
+    }
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="Ramp concurrent clients sending a mix of requests to the API and report its capacity at each step."
+    )
+    parser.add_argument("--url", help="API to test; if not given, the API is started against the local upstream stand-in")
+    parser.add_argument("--steps", default="1,2,4,8,16", help="Concurrent clients of each step")
+    parser.add_argument("--step-duration", type=float, default=30, help="Seconds of each step")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("geosparql=8,xml_one_narrative=1,csv=1"),
+                        help="Weighted scenarios, e.g. geosparql=8,xml_one_narrative=1,csv=1")
+    parser.add_argument("--timeout", type=float, default=120, help="Timeout of one request, in seconds (timeouts count as errors)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--api-port", type=int, default=8090)
+    parser.add_argument("--mock-port", type=int, default=8091)
+    parser.add_argument("--rate-limit-delay", default="0", help="RATE_LIMIT_DELAY of the API under test")
+    parser.add_argument("--retry-delay", default="0", help="RETRY_DELAY of the API under test")
+    parser.add_argument("--output", help="JSON report (default benchmarks/results/load-<commit>.json)")
+    args, mock_args = parser.parse_known_args()  # the other options (--latency-ms, --error-rate, ...) go to the mock
+
+    commit = git_commit()
+    steps = [int(step) for step in args.steps.split(",")]
+    report = {
+        "commit": commit,
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "mix": args.mix,
+        "step_duration": args.step_duration,
+        "mock": mock_args,
+        "steps": [],
+    }
+
+    processes = []
+    workdir = tempfile.TemporaryDirectory()
+    try:
+        api_url = args.url
+        if api_url is None:
+            mock_url = f"http://127.0.0.1:{args.mock_port}"
+            processes.append(subprocess.Popen(
+                [sys.executable, os.path.join(BENCHMARKS_DIR, "mock_upstream.py"), "--port", str(args.mock_port), *mock_args]
+            ))
+            wait_until_ready(mock_url + "/docs", processes[-1])
+            env = {
+                **os.environ,
+                **upstream_env(mock_url),
+                "WIKIFIER_API_KEY": os.getenv("WIKIFIER_API_KEY", "benchmark"),
+                "RATE_LIMIT_DELAY": args.rate_limit_delay,
+                "RETRY_DELAY": args.retry_delay,
+                "RESPONSE_CACHE_SIZE": "0",  # measure the pipeline, not the response cache
+                "ARTIFACT_DIR": os.path.join(workdir.name, "artifacts"),
+            }
+            processes.append(start_api(args.api_port, env, workdir.name))
+            api_url = f"http://127.0.0.1:{args.api_port}"
+
+        for i, concurrency in enumerate(steps):
+            result = run_step(api_url, concurrency, args.step_duration, args.mix, args.timeout, args.seed + i)
+            report["steps"].append(result)
+            lag = result["event_loop_lag"]
+            print(f"{concurrency:>4} clients  {result['throughput_rps']:>7.2f} req/s  p50 {result['p50_s']}s  "
+                  f"p95 {result['p95_s']}s  p99 {result['p99_s']}s  errors {result['error_rate']}  "
+                  f"loop lag mean {lag['mean_s']}s p99 {lag['p99_s']}s")
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait()
+        workdir.cleanup()
+
+    output = args.output or os.path.join(BENCHMARKS_DIR, "results", f"load-{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nReport saved in: {output}")
@@ -0,0 +1,198 @@
+import argparse
+import asyncio
+import hashlib
+import random
+import re
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+# Local stand-in for Wikifier, Wikidata (SPARQL and API), Wikipedia, GeoNames and Overpass.
+# Responses are synthetic but deterministic: the same name always gets the same QID, OSM relation and geometry.
+
+app = FastAPI()
+
+config = {
+    "latency_ms": 0.0,  # default latency of every upstream
+    "jitter_ms": 0.0,  # uniform random delay added to it
+    "error_rate": 0.0,  # share of requests answered with 503
+    "upstreams": {},  # upstream -> {"latency_ms": ..., "error_rate": ...} overrides
+    "ways": 4,  # ways per Overpass relation
+    "way_points": 50,  # points per way
+}
+
+GEONAMES_RDF = """<?xml version="1.0" encoding="UTF-8"?>
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" xmlns:gn="http://www.geonames.org/ontology#">
+  <gn:Feature rdf:about="https://sws.geonames.org/{id}/">
+    <gn:name>{name}</gn:name>
+    <gn:wikipediaArticle rdf:resource="https://en.wikipedia.org/wiki/{name}"/>
+  </gn:Feature>
+</rdf:RDF>
+"""
+
+
+def stable_hash(value):
+    return int(hashlib.md5(value.encode("utf-8")).hexdigest()[:8], 16)
+
+def qid_for(name):
+    return f"Q{stable_hash(name.lower()) % 10_000_000 + 1}"
+
+def center_for(qid):
+    h = stable_hash(qid)
+    return (h % 36000) / 100 - 180, (h // 36000 % 17000) / 100 - 85
+
+def is_geographic(qid):
+    return stable_hash(qid) % 10 < 7
+
+def osm_id_for(qid):
+    h = stable_hash(qid + "osm")
+    return str(h % 10_000_000 + 1) if h % 2 == 0 else None
+
+
+async def simulate(upstream):
+    """
+    Wait the configured latency and return an error response if this request has to fail.
+    """
+    settings = {**config, **config["upstreams"].get(upstream, {})}
+    delay = settings["latency_ms"] + random.uniform(0, settings["jitter_ms"])
+    if delay > 0:
+        await asyncio.sleep(delay / 1000)
+    if random.random() < settings["error_rate"]:
+        return JSONResponse(status_code=503, content={"error": f"simulated {upstream} failure"})
+    return None
+
+
+@app.post("/wikifier/annotate-article")
+async def wikifier(request: Request):
+    error = await simulate("wikifier")
+    if error:
+        return error
+    form = await request.form()
+    names = {}  # name -> support records of its occurrences (chTo is the last character, as in Wikifier)
+    for match in re.finditer(r"\b[A-Z][a-zà-ÿ]{2,}\b", form.get("text", "")):
+        names.setdefault(match.group(), []).append({"chFrom": match.start(), "chTo": match.end() - 1})
+    annotations = [
+        {"title": name, "wikiDataItemId": qid_for(name), "cosine": 0.9, "pageRank": 0.01, "support": support}
+        for name, support in list(names.items())[:50]
+    ]
+    return {"annotations": annotations}
+
+
+@app.get("/wikidata/sparql")
+async def wikidata_sparql(query: str):
+    error = await simulate("wikidata_sparql")
+    if error:
+        return error
+    qid = re.search(r"wd:(Q\d+)", query)
+    qid = qid.group(1) if qid else None
+    if query.lstrip().startswith("ASK"):
+        return {"head": {}, "boolean": is_geographic(qid)}
+    bindings = []
+    if "P402" in query:
+        osm_id = osm_id_for(qid)
+        if osm_id:
+            bindings.append({"osmId": {"type": "literal", "value": osm_id}})
+    elif "P625" in query:
+        lon, lat = center_for(qid)
+        bindings.append({"coord": {"type": "literal", "value": f"Point({lon} {lat})"}})
+    elif "P1566" in query:
+        geonames_id = re.search(r'P1566 "(\d+)"', query).group(1)
+        if stable_hash(geonames_id) % 2 == 0:
+            bindings.append({
+                "item": {"type": "uri", "value": f"http://www.wikidata.org/entity/{qid_for(geonames_id)}"},
+                "itemLabel": {"type": "literal", "value": f"Place {geonames_id}"},
+            })
+    return {"head": {}, "results": {"bindings": bindings}}
+
+
+@app.get("/wikidata/w/api.php")
+async def wikidata_api(request: Request):
+    error = await simulate("wikidata_api")
+    if error:
+        return error
+    params = request.query_params
+    if params.get("action") == "wbgetentities":
+        language = params.get("languages", "en")
+        return {"entities": {
+            qid: {"labels": {language: {"language": language, "value": f"Label {qid}"}}}
+            for qid in params.get("ids", "").split("|")
+        }}
+    search = params.get("search", "")
+    return {"search": [{"id": qid_for(search), "label": search, "description": "synthetic entity"}]}
+
+
+@app.get("/wikipedia/{host}/w/api.php")
+async def wikipedia_api(host: str, titles: str):
+    error = await simulate("wikipedia")
+    if error:
+        return error
+    return {"query": {"pages": {"1": {"title": titles, "pageprops": {"wikibase_item": qid_for(titles)}}}}}
+
+
+@app.get("/geonames/{geonames_id}/about.rdf")
+async def geonames_rdf(geonames_id: str):
+    error = await simulate("geonames")
+    if error:
+        return error
+    return Response(content=GEONAMES_RDF.format(id=geonames_id, name=f"Place_{geonames_id}"), media_type="application/rdf+xml")
+
+
+@app.get("/overpass/api/interpreter")
+async def overpass(data: str):
+    """
+    One relation whose outer ring is a square around the entity, split into config["ways"] ways.
+    """
+    error = await simulate("overpass")
+    if error:
+        return error
+    osm_id = int(re.search(r"relation\((\d+)\)", data).group(1))
+    lon, lat = center_for(f"osm{osm_id}")
+    size = 0.05
+    corners = [(lon - size, lat - size), (lon + size, lat - size), (lon + size, lat + size), (lon - size, lat + size)]
+    ring = []
+    steps = config["way_points"] * config["ways"] // 4
+    for (x0, y0), (x1, y1) in zip(corners, corners[1:] + corners[:1]):
+        ring.extend((x0 + (x1 - x0) * i / steps, y0 + (y1 - y0) * i / steps) for i in range(steps))
+    ring.append(ring[0])
+    step = len(ring) // config["ways"]
+    members = []
+    for w in range(config["ways"]):
+        end = len(ring) if w == config["ways"] - 1 else (w + 1) * step + 1
+        members.append({
+            "type": "way",
+            "ref": osm_id * 100 + w,
+            "role": "outer",
+            "geometry": [{"lon": x, "lat": y} for x, y in ring[w * step:end]],
+        })
+    return {"elements": [{"type": "relation", "id": osm_id, "members": members, "tags": {"type": "multipolygon"}}]}
+
+
+def parse_overrides(values, key):
+    for value in values:
+        upstream, _, number = value.partition("=")
+        config["upstreams"].setdefault(upstream, {})[key] = float(number)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Local stand-in for every upstream service used by the API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Latency of every upstream")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="Random delay added to the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with 503")
+    parser.add_argument("--upstream-latency-ms", action="append", default=[], metavar="UPSTREAM=MS",
+                        help="Latency of one upstream (wikifier, wikidata_sparql, wikidata_api, wikipedia, geonames, overpass)")
+    parser.add_argument("--upstream-error-rate", action="append", default=[], metavar="UPSTREAM=RATE",
+                        help="Error rate of one upstream")
+    parser.add_argument("--ways", type=int, default=4, help="Ways per Overpass relation")
+    parser.add_argument("--way-points", type=int, default=50, help="Points per way")
+    args = parser.parse_args()
+
+    config.update(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+                  ways=args.ways, way_points=args.way_points)
+    parse_overrides(args.upstream_latency_ms, "latency_ms")
+    parse_overrides(args.upstream_error_rate, "error_rate")
+
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,164 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS_DIR = os.path.join(ROOT, "benchmarks")
+
+SCENARIOS = {  # name -> (endpoint, input file, how the file is sent)
+    "geosparql": ("/geosparql?download=false", "sample_text.txt", "text"),
+    "xml_one_narrative": ("/analyze-from-xml?download=false", "sparql_one_narrative.xml", "file"),
+    "xml_mingei_all": ("/analyze-from-xml?download=false", "sparql_mingei_all.xml", "file"),
+    "csv": ("/analyze-from-csv", "results_filtered.csv", "file"),
+}
+
+
+def upstream_env(mock_url):
+    return {
+        "WIKIFIER_URL": f"{mock_url}/wikifier/annotate-article",
+        "WIKIDATA_SPARQL_URL": f"{mock_url}/wikidata/sparql",
+        "WIKIDATA_API_URL": f"{mock_url}/wikidata/w/api.php",
+        "WIKIPEDIA_API_URL": f"{mock_url}/wikipedia/{{host}}/w/api.php",
+        "OVERPASS_URL": f"{mock_url}/overpass/api/interpreter",
+        "GEONAMES_RDF_URL": f"{mock_url}/geonames/{{id}}/about.rdf",
+    }
+
+def wait_until_ready(url, process, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with code {process.returncode}")
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not start in {timeout} seconds")
+
+def start_api(port, env, workdir):
+    # run from an empty directory, so no local GeoNames/OSM store is found (logs go to stderr, or LOG_FILE if set)
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", ROOT, "--port", str(port), "--log-level", "warning"],
+        cwd=workdir, env=env
+    )
+    wait_until_ready(f"http://127.0.0.1:{port}/metrics", process)
+    return process
+
+def send(api_url, scenario, timeout):
+    endpoint, filename, mode = SCENARIOS[scenario]
+    path = os.path.join(ROOT, filename)
+    start = time.perf_counter()
+    if mode == "text":
+        with open(path, encoding="utf-8") as f:
+            response = requests.post(api_url + endpoint, json={"text": f.read()}, timeout=timeout)
+    else:
+        with open(path, "rb") as f:
+            response = requests.post(api_url + endpoint, files={"file": (filename, f)}, timeout=timeout)
+    return time.perf_counter() - start, response.status_code, len(response.content)
+
+def percentile(values, p):
+    values = sorted(values)
+    index = (len(values) - 1) * p / 100
+    low, high = int(index), min(int(index) + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (index - low)
+
+def run_scenario(scenario, api_url, repeat, concurrency, timeout):
+    """
+    One cold request (empty caches), then `repeat` warm requests sent by `concurrency` clients.
+    """
+    cold, status, size = send(api_url, scenario, timeout)
+    errors = int(status != 200)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(lambda _: send(api_url, scenario, timeout), range(repeat)))
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency for latency, _, _ in results]
+    errors += sum(status != 200 for _, status, _ in results)
+    return {
+        "cold_s": round(cold, 4),
+        "p50_s": round(percentile(latencies, 50), 4),
+        "p90_s": round(percentile(latencies, 90), 4),
+        "p99_s": round(percentile(latencies, 99), 4),
+        "mean_s": round(statistics.mean(latencies), 4),
+        "throughput_rps": round(repeat / elapsed, 2),
+        "requests": repeat + 1,
+        "errors": errors,
+        "response_bytes": size,
+    }
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the API endpoints against the local upstream stand-in (benchmarks/mock_upstream.py)."
+    )
+    parser.add_argument("--scenario", action="append", choices=list(SCENARIOS), help="Scenario to run, can be repeated (default: all)")
+    parser.add_argument("--repeat", type=int, default=10, help="Warm requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=1, help="Concurrent clients")
+    parser.add_argument("--timeout", type=float, default=600, help="Timeout of one request, in seconds")
+    parser.add_argument("--api-port", type=int, default=8090)
+    parser.add_argument("--mock-port", type=int, default=8091)
+    parser.add_argument("--rate-limit-delay", default="0", help="RATE_LIMIT_DELAY of the API under test")
+    parser.add_argument("--retry-delay", default="0", help="RETRY_DELAY of the API under test")
+    parser.add_argument("--output", help="JSON report (default benchmarks/results/<commit>.json)")
+    args, mock_args = parser.parse_known_args()  # the other options (--latency-ms, --error-rate, ...) go to the mock
+
+    commit = git_commit()
+    mock_url = f"http://127.0.0.1:{args.mock_port}"
+    mock = subprocess.Popen([sys.executable, os.path.join(BENCHMARKS_DIR, "mock_upstream.py"), "--port", str(args.mock_port), *mock_args])
+    report = {
+        "commit": commit,
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "repeat": args.repeat,
+        "concurrency": args.concurrency,
+        "mock": mock_args,
+        "scenarios": {},
+    }
+    try:
+        wait_until_ready(mock_url + "/docs", mock)
+        env = {
+            **os.environ,
+            **upstream_env(mock_url),
+            "WIKIFIER_API_KEY": os.getenv("WIKIFIER_API_KEY", "benchmark"),
+            "RATE_LIMIT_DELAY": args.rate_limit_delay,
+            "RETRY_DELAY": args.retry_delay,
+            "RESPONSE_CACHE_SIZE": "0",  # measure the pipeline, not the response cache
+        }
+        for scenario in args.scenario or SCENARIOS:
+            # a fresh API process per scenario, so every cold request starts from empty caches
+            with tempfile.TemporaryDirectory() as workdir:
+                api = start_api(args.api_port, {**env, "ARTIFACT_DIR": os.path.join(workdir, "artifacts")}, workdir)
+                try:
+                    result = run_scenario(scenario, f"http://127.0.0.1:{args.api_port}", args.repeat, args.concurrency, args.timeout)
+                finally:
+                    api.terminate()
+                    api.wait()
+            report["scenarios"][scenario] = result
+            print(f"{scenario:<18} cold {result['cold_s']:>8.3f}s  p50 {result['p50_s']:>8.3f}s  p90 {result['p90_s']:>8.3f}s  "
+                  f"p99 {result['p99_s']:>8.3f}s  {result['throughput_rps']:>7.2f} req/s  errors {result['errors']}")
+    finally:
+        mock.terminate()
+        mock.wait()
+
+    output = args.output or os.path.join(BENCHMARKS_DIR, "results", f"{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nReport saved in: {output}")
@@ -0,0 +1,79 @@
+import argparse
+import csv
+import os
+import sqlite3
+import sys
+
+# GeoNames dumps are tab separated without quoting and some fields are very long
+csv.field_size_limit(sys.maxsize)
+
+
+def create_index(path):
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("""
+        CREATE TABLE geonames (
+            id INTEGER PRIMARY KEY,
+            name TEXT,
+            wikipedia_url TEXT
+        )
+    """)
+    return conn
+
+
+def read_rows(filepath):
+    with open(filepath, mode='r', encoding='utf-8', newline='') as f:
+        reader = csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE)
+        for row in reader:
+            if row and not row[0].startswith('#'):
+                yield row
+
+
+def load_names(conn, all_countries):
+    # allCountries.txt: geonameid, name, asciiname, alternatenames, latitude, longitude, ...
+    rows = ((int(row[0]), row[1]) for row in read_rows(all_countries) if len(row) > 1)
+    conn.executemany("INSERT OR REPLACE INTO geonames (id, name) VALUES (?, ?)", rows)
+    conn.commit()
+
+
+def load_wikipedia_links(conn, links_file, lang="en"):
+    # alternateNames(V2).txt: alternateNameId, geonameid, isolanguage, alternate name, ...
+    # Wikipedia articles are stored as alternate names with the pseudo language 'link'.
+    host = f"{lang}.wikipedia.org"
+    rows = (
+        (row[3], int(row[1]))
+        for row in read_rows(links_file)
+        if len(row) > 3 and row[2] == "link" and host in row[3]
+    )
+    conn.executemany(
+        "UPDATE geonames SET wikipedia_url = ? WHERE id = ? AND wikipedia_url IS NULL",
+        rows
+    )
+    conn.commit()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="Build the local GeoNames index (id -> name, id -> Wikipedia URL) used by the API."
+    )
+    parser.add_argument("all_countries", help="Path to allCountries.txt")
+    parser.add_argument("links", nargs="+", help="Alternate-names files containing the Wikipedia 'link' rows")
+    parser.add_argument("-o", "--output", default="geonames.sqlite", help="Output SQLite file")
+    parser.add_argument("--lang", default="en", help="Wikipedia language to keep")
+    args = parser.parse_args()
+
+    # built next to the output and moved into place at the end, so the API never reads a partial file
+    partial = args.output + ".tmp"
+    connection = create_index(partial)
+    load_names(connection, args.all_countries)
+    for links_file in args.links:
+        load_wikipedia_links(connection, links_file, args.lang)
+    connection.execute("VACUUM")
+    connection.close()
+    os.replace(partial, args.output)
+
+    print(f"GeoNames index saved in: {args.output}")
@@ -0,0 +1,84 @@
+import argparse
+import os
+import sqlite3
+
+import osmium
+import shapely
+
+
+class RelationAreaHandler(osmium.SimpleHandler):
+    """
+    Collect the multipolygons assembled by osmium from the relations of a PBF extract
+    and write them as WKB with their bbox, keyed by relation id.
+    """
+
+    def __init__(self, conn, boundaries_only=False, batch_size=1000):
+        super().__init__()
+        self.conn = conn
+        self.boundaries_only = boundaries_only
+        self.batch_size = batch_size
+        self.wkb_factory = osmium.geom.WKBFactory()
+        self.batch = []
+        self.count = 0
+
+    def area(self, a):
+        if a.from_way():
+            return  # only relations are referenced by Wikidata (P402)
+        if self.boundaries_only and "boundary" not in a.tags:
+            return
+        try:
+            wkb = bytes.fromhex(self.wkb_factory.create_multipolygon(a))
+        except RuntimeError:
+            return  # broken multipolygon in the extract
+        minx, miny, maxx, maxy = shapely.bounds(shapely.from_wkb(wkb))
+        self.batch.append((a.orig_id(), minx, miny, maxx, maxy, wkb))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO relations (id, minx, miny, maxx, maxy, wkb) VALUES (?, ?, ?, ?, ?, ?)",
+            self.batch
+        )
+        self.conn.commit()
+        self.count += len(self.batch)
+        self.batch = []
+
+
+def create_store(path):
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("""
+        CREATE TABLE relations (
+            id INTEGER PRIMARY KEY,
+            minx REAL, miny REAL, maxx REAL, maxy REAL,
+            wkb BLOB
+        )
+    """)
+    return conn
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="Build the offline OSM relation geometry store used by the API from a .pbf extract."
+    )
+    parser.add_argument("pbf", help="Path to the OSM .pbf extract")
+    parser.add_argument("-o", "--output", default="osm_relations.sqlite", help="Output SQLite file")
+    parser.add_argument("--boundaries-only", action="store_true", help="Keep only relations with a 'boundary' tag")
+    args = parser.parse_args()
+
+    # built next to the output and moved into place at the end, so the API never reads a partial file
+    partial = args.output + ".tmp"
+    connection = create_store(partial)
+    handler = RelationAreaHandler(connection, boundaries_only=args.boundaries_only)
+    handler.apply_file(args.pbf, locations=True, idx="flex_mem")
+    handler.flush()
+    connection.execute("VACUUM")
+    connection.close()
+    os.replace(partial, args.output)
+
+    print(f"{handler.count} relation geometries saved in: {args.output}")
@@ -1,47 +1,120 @@
 # ======= Import libraries =======
 
-from fastapi import FastAPI, HTTPException, Query
-from fastapi.responses import FileResponse, JSONResponse
-from urllib.parse import urlparse, unquote
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from urllib.parse import urlparse, unquote, urlencode, parse_qsl
 from fastapi import UploadFile, File
+from starlette.concurrency import run_in_threadpool
 import xml.etree.ElementTree as ET
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
 from langdetect import detect
 from uuid import uuid4
 import spacy
 import requests
 import time
+import asyncio
 import pandas as pd
+import numpy as np
+from shapely.geometry import Point, box
 import json
+import orjson
+import brotli
 import os
 import re
+import sqlite3
+import gzip
+import zlib
+import hashlib
+import hmac
+import math
+import tempfile
+import threading
 import logging
+import logging.handlers
+import queue
+import random
+import atexit
 import sys
 import traceback
+from collections import OrderedDict, deque
+from bisect import bisect_right
+import base64
+import io
+from itertools import chain, count
+import heapq
+from operator import itemgetter
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
 
 # ======= Logger =======
 
-# Logger config
-logger = logging.getLogger("warnings_logger")
-logger.setLevel(logging.INFO)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")  # per-module levels, e.g. "geosparql.pipeline=WARNING,geosparql.csv=DEBUG"
+LOG_FILE = os.getenv("LOG_FILE")  # JSON lines are also appended to this file
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))  # share of the per-entity lines that are kept
 
-# File handler
-file_handler = logging.FileHandler("warnings.txt", mode="w", encoding="utf-8")
-file_handler.setLevel(logging.INFO)
-file_formatter = logging.Formatter('%(asctime)s - %(message)s')
-file_handler.setFormatter(file_formatter)
+correlation_id = ContextVar("correlation_id", default=None)  # id of the request being served
 
-# Console handler
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO)
-console_formatter = logging.Formatter('%(message)s')
-console_handler.setFormatter(console_formatter)
+STANDARD_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "correlation_id", "sampled"}
 
-# add handlers to logger
-if not logger.hasHandlers():
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+class JSONFormatter(logging.Formatter):
+    """
+    One JSON object per line. The attributes passed with extra={...} become fields of the object.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "correlation_id": getattr(record, "correlation_id", None),
+        }
+        for name, value in vars(record).items():
+            if name not in STANDARD_RECORD_ATTRIBUTES:
+                entry[name] = value
+        return orjson.dumps(entry, default=str).decode("utf-8")
+
+class ContextFilter(logging.Filter):
+    """
+    Stamp records with the correlation id of the request and drop part of the sampled ones (extra={"sampled": True}).
+    Runs in the thread that logs, before the record is queued.
+    """
+
+    def filter(self, record):
+        if getattr(record, "sampled", False) and random.random() >= LOG_SAMPLE_RATE:
+            return False
+        record.correlation_id = correlation_id.get()
+        return True
+
+# records are queued by the request threads and written by a background thread
+logger = logging.getLogger("geosparql")
+pipeline_logger = logging.getLogger("geosparql.pipeline")
+xml_logger = logging.getLogger("geosparql.xml")
+csv_logger = logging.getLogger("geosparql.csv")
+
+if not logger.handlers:
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    logger.addHandler(queue_handler)
+    logger.setLevel(LOG_LEVEL.upper())
+    logger.propagate = False
+
+    output_handlers = [logging.StreamHandler()]
+    if LOG_FILE:
+        output_handlers.append(logging.FileHandler(LOG_FILE, mode="a", encoding="utf-8"))
+    for output_handler in output_handlers:
+        output_handler.setFormatter(JSONFormatter())
+    log_listener = logging.handlers.QueueListener(log_queue, *output_handlers)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+for module_level in filter(None, LOG_LEVELS.split(",")):
+    module, _, level = module_level.partition("=")
+    logging.getLogger(module.strip()).setLevel(level.strip().upper())
 
 # ======= Init =======
 
@@ -61,6 +134,15 @@ GEOSPARQL_CONTEXT = {
         "Feature":    "geo:Feature",
         "Geometry":   "geo:Geometry",
         "hasGeometry":"geo:hasGeometry",
+        "Document":   "schema:CreativeWork",
+        "index":      "schema:position",
+        "lang":       "schema:inLanguage",
+        "mentions":   "schema:mentions",
+        "Mention":    "schema:Quotation",
+        "about":      "schema:about",
+        "literal":    "schema:position",
+        "start":      "schema:startOffset",
+        "end":        "schema:endOffset",
         "asWKT": {
             "@id": "geo:asWKT",
             "@type": "geo:wktLiteral"
@@ -68,11 +150,42 @@ GEOSPARQL_CONTEXT = {
     }
 }
 
+OUTPUT_FORMATS = {  # format -> (media type, file extension)
+    "jsonld": ("application/ld+json", "jsonld"),
+    "geoparquet": ("application/vnd.apache.parquet", "parquet"),
+    "flatgeobuf": ("application/flatgeobuf", "fgb"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+}
+
+not_supported_format_message = "Format not supported. Please insert one value among 'jsonld', 'geoparquet', 'flatgeobuf' or 'ndjson'."
+
+ARTIFACT_DIR = os.getenv("ARTIFACT_DIR", os.path.join(tempfile.gettempdir(), "geosparql-artifacts"))
+ARTIFACT_TTL = int(os.getenv("ARTIFACT_TTL", "86400"))  # seconds
+ARTIFACT_MAX_BYTES = int(os.getenv("ARTIFACT_MAX_BYTES", str(2 * 1024 ** 3)))
+
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "256"))  # number of cached responses, 0 disables the cache
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(32 * 1024 ** 2)))  # larger bodies are not cached
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))  # bytes, smaller responses are sent as they are
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "5"))
+TILE_CACHE_SIZE = int(os.getenv("TILE_CACHE_SIZE", "2048"))  # number of vector tiles kept in memory
+RESPONSE_CACHE_CONTROL = os.getenv("RESPONSE_CACHE_CONTROL", "private, no-cache")  # clients revalidate with If-None-Match
+
+GEOSPARQL_CONTEXT_URL = os.getenv("GEOSPARQL_CONTEXT_URL")  # if not set, the context served by /context.jsonld
+
 SUPPORTED_LANGUAGES = ["en", "it", "de", "fr", "es", "pt", "nl", "ru", "pl", "xx"]  # official Wikifier supported languages
 
 not_supported_message = "Language not supported. Please insert one value among \'en\' (English), \'it\' (Italian), \'fr\' (French), \'de\' (Deutsch), \'ru\' (Russian), \'pt\' (Portuguese), \'es\' (Spanish), \'nl\' (Dutch) , \'pl\' (Polish) or \'xx\' (for multi language texts)."
 
-app = FastAPI()
+EVENT_LOOP_LAG_INTERVAL = float(os.getenv("EVENT_LOOP_LAG_INTERVAL", "0.5"))  # seconds between two event loop lag probes
+
+@asynccontextmanager
+async def lifespan(app):
+    monitor = asyncio.create_task(monitor_event_loop_lag())
+    yield
+    monitor.cancel()
+
+app = FastAPI(lifespan=lifespan)
 
 SPACY_MODELS = {
     "en": "en_core_web_sm",
@@ -89,16 +202,518 @@ SPACY_MODELS = {
 
 loaded_models = {}
 
+GEONAMES_INDEX_PATH = os.getenv("GEONAMES_INDEX_PATH", "geonames.sqlite")  # built with build_geonames_index.py
+GEONAMES_RDF_CACHE_SIZE = int(os.getenv("GEONAMES_RDF_CACHE_SIZE", "10000"))  # GeoNames ids whose about.rdf fields are kept in memory
+geonames_rdf_cache = OrderedDict()  # GeoNames id -> (name, en.wikipedia.org URL) from about.rdf, LRU order
+geonames_rdf_lock = threading.Lock()
+
+DETAIL_LEVELS = ["full", "medium", "low", "bbox", "centroid"]
+SIMPLIFY_TOLERANCES = {"medium": 0.001, "low": 0.01}  # degrees, topology-preserving simplification
+
+not_supported_detail_message = "Detail not supported. Please insert one value among 'full', 'medium', 'low', 'bbox' or 'centroid'."
+
+COORDINATE_PRECISION = int(os.getenv("COORDINATE_PRECISION", "6"))  # decimal digits of the stored coordinates (6 ~ 0.1 m)
+
+GEOMETRY_CACHE_SIZE = int(os.getenv("GEOMETRY_CACHE_SIZE", "5000"))  # resolved QIDs whose geometries are kept in memory
+
+OSM_STORE_PATH = os.getenv("OSM_STORE_PATH", "osm_relations.sqlite")  # built with build_osm_store.py
+local_stores = {}  # path -> (read-only connection, mtime of the file it was opened from)
+local_stores_lock = threading.Lock()
+
+# upstream services, they can point to a local stand-in (see benchmarks/mock_upstream.py)
+WIKIFIER_URL = os.getenv("WIKIFIER_URL", "http://www.wikifier.org/annotate-article")
+WIKIDATA_SPARQL_URL = os.getenv("WIKIDATA_SPARQL_URL", "https://query.wikidata.org/sparql")
+WIKIDATA_API_URL = os.getenv("WIKIDATA_API_URL", "https://www.wikidata.org/w/api.php")
+WIKIPEDIA_API_URL = os.getenv("WIKIPEDIA_API_URL", "https://{host}/w/api.php")  # {host}: host of the Wikipedia article
+OVERPASS_URL = os.getenv("OVERPASS_URL", "https://overpass-api.de/api/interpreter")
+GEONAMES_RDF_URL = os.getenv("GEONAMES_RDF_URL", "https://sws.geonames.org/{id}/about.rdf")
+
+# requests per second allowed to each upstream host, shared fairly by the concurrent requests
+UPSTREAM_RATE_LIMITS = {
+    host.strip(): float(rate)
+    for host, _, rate in (item.partition("=") for item in os.getenv(
+        "UPSTREAM_RATE_LIMITS",
+        "www.wikifier.org=5,query.wikidata.org=5,www.wikidata.org=10,overpass-api.de=1,sws.geonames.org=5"
+    ).split(",") if item)
+}
+UPSTREAM_DEFAULT_RATE = float(os.getenv("UPSTREAM_DEFAULT_RATE", "0"))  # hosts not listed above, 0 means no limit
+INTERACTIVE_UPSTREAM_WEIGHT = int(os.getenv("INTERACTIVE_UPSTREAM_WEIGHT", "4"))  # share of the upstream budget of an interactive request relative to a bulk one
+
+RATE_LIMIT_DELAY = float(os.getenv("RATE_LIMIT_DELAY", "4"))  # seconds slept after resolving a new geometry
+RETRY_DELAY = float(os.getenv("RETRY_DELAY", "10"))  # seconds slept before retrying a failed geometry
+
+BATCH_MAX_DOCUMENTS = int(os.getenv("BATCH_MAX_DOCUMENTS", "100"))
+
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")  # enables the /admin endpoints, sent in the X-Admin-Token header
+TRACEMALLOC_MAX_SNAPSHOTS = int(os.getenv("TRACEMALLOC_MAX_SNAPSHOTS", "10"))
+
+MAX_RUNNING_PIPELINES = int(os.getenv("MAX_RUNNING_PIPELINES", "4"))  # pipelines executed at once
+MAX_RUNNING_BULK = int(os.getenv("MAX_RUNNING_BULK", "2"))  # of which bulk jobs (XML, CSV, batch)
+MAX_QUEUED_INTERACTIVE = int(os.getenv("MAX_QUEUED_INTERACTIVE", "32"))  # requests waiting for a slot, beyond them 429
+MAX_QUEUED_BULK = int(os.getenv("MAX_QUEUED_BULK", "4"))
+
+DATA_VERSION = os.getenv("DATA_VERSION", "1")  # bump to invalidate cached geometries and responses
+
 WIKIFIER_API_KEY = os.getenv("WIKIFIER_API_KEY")
 if not WIKIFIER_API_KEY:
     raise EnvironmentError("WIKIFIER_API_KEY not defined in environment.")
 
+HTTP_ARCHIVE_MODE = os.getenv("HTTP_ARCHIVE_MODE")  # "record" or "replay" the upstream responses, unset to go to the network
+HTTP_ARCHIVE_PATH = os.getenv("HTTP_ARCHIVE_PATH", "http_archive.sqlite")
+ARCHIVE_IGNORED_PARAMS = {"userKey"}  # credentials are not part of the archive keys
+if HTTP_ARCHIVE_MODE not in (None, "", "record", "replay"):
+    raise EnvironmentError("HTTP_ARCHIVE_MODE must be 'record' or 'replay'.")
+
+
+# ======= Metrics =======
+STAGE_SECONDS = Histogram(
+    "geosparql_stage_seconds", "Time spent in each stage of the pipeline", ["stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+)
+UPSTREAM_REQUESTS = Counter("geosparql_upstream_requests_total", "Requests sent to upstream services", ["upstream", "status"])
+UPSTREAM_SECONDS = Histogram(
+    "geosparql_upstream_request_seconds", "Latency of the requests sent to upstream services", ["upstream"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+)
+RETRIES = Counter("geosparql_retries_total", "Retried pipeline operations", ["stage"])
+WAIT_SECONDS = Counter("geosparql_wait_seconds_total", "Time spent sleeping to respect rate limits or before retrying", ["reason"])
+CACHE_LOOKUPS = Counter("geosparql_cache_lookups_total", "Cache lookups by cache and result (hit or miss)", ["cache", "result"])
+UPSTREAM_COALESCED = Counter("geosparql_upstream_coalesced_total", "Upstream requests answered by an identical request already in flight", ["upstream"])
+IN_FLIGHT = Gauge("geosparql_in_flight_requests", "Pipeline requests being processed", ["endpoint"])
+ADMISSION_QUEUED = Gauge("geosparql_admission_queued_requests", "Requests waiting for a pipeline slot", ["endpoint_class"])
+ADMISSION_REJECTED = Counter("geosparql_admission_rejected_total", "Requests rejected with 429 because the queue was full", ["endpoint_class"])
+EVENT_LOOP_LAG = Histogram(
+    "geosparql_event_loop_lag_seconds", "How late the event loop runs a periodic timer (blocking calls on the loop show up here)",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+
+async def monitor_event_loop_lag():
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        EVENT_LOOP_LAG.observe(max(0.0, loop.time() - start - EVENT_LOOP_LAG_INTERVAL))
+
+
+# ======= Request timings =======
+class RequestTimings:
+    """
+    Time spent by one request in each stage, upstream service and wait, plus its cache lookups.
+    Reported in the Server-Timing header and, with ?debug=timings, in the response body.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans = {"stage": {}, "upstream": {}, "wait": {}}  # kind -> name -> [calls, seconds]
+        self.caches = {}  # cache -> [hits, misses]
+
+    def add(self, kind, name, seconds):
+        span = self.spans[kind].setdefault(name, [0, 0.0])
+        span[0] += 1
+        span[1] += seconds
+
+    def add_cache_lookup(self, cache, hit):
+        self.caches.setdefault(cache, [0, 0])[0 if hit else 1] += 1
+
+    def total(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self):
+        metrics = [f"total;dur={self.total() * 1000:.1f}"]
+        for kind, spans in self.spans.items():
+            for name, (calls, seconds) in spans.items():
+                metrics.append(f'{kind}-{name};dur={seconds * 1000:.1f};desc="{calls} calls"')
+        for cache, (hits, misses) in self.caches.items():
+            metrics.append(f'cache-{cache};desc="{hits} hits, {misses} misses"')
+        return ", ".join(metrics)
+
+    def as_dict(self):
+        timings = {"total_ms": round(self.total() * 1000, 1)}
+        for kind, spans in self.spans.items():
+            timings[kind] = {
+                name: {"calls": calls, "ms": round(seconds * 1000, 1)}
+                for name, (calls, seconds) in spans.items()
+            }
+        timings["cache"] = {cache: {"hits": hits, "misses": misses} for cache, (hits, misses) in self.caches.items()}
+        return timings
+
+request_timings = ContextVar("request_timings", default=None)  # RequestTimings of the request being served
+
+def add_span(kind, name, seconds):
+    timings = request_timings.get()
+    if timings is not None:
+        timings.add(kind, name, seconds)
+
+def debug_timings(request):
+    return request.query_params.get("debug") == "timings"
+
+@contextmanager
+def stage(name):
+    """
+    Time a pipeline stage into STAGE_SECONDS and the request timings, as a context manager or a function decorator.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - start)
+
+def observe_stage(name, seconds):
+    STAGE_SECONDS.labels(name).observe(seconds)
+    add_span("stage", name, seconds)
+
+def record_cache_lookup(cache, hit):
+    CACHE_LOOKUPS.labels(cache, "hit" if hit else "miss").inc()
+    timings = request_timings.get()
+    if timings is not None:
+        timings.add_cache_lookup(cache, hit)
+
+def wait(seconds, reason):
+    if seconds <= 0:
+        return
+    WAIT_SECONDS.labels(reason).inc(seconds)
+    add_span("wait", reason, seconds)
+    time.sleep(seconds)
+
+
+# ======= HTTP client =======
+class UpstreamScheduler:
+    """
+    Rate budget of each upstream host, shared fairly by the requests calling it.
+    Calls waiting for the budget are released by weighted fair queuing: each call is tagged with a virtual
+    start time that grows by 1/weight per call of its tenant, and the smallest tag goes first.
+    A tenant keeps its last tag between calls, so a request sending its calls one at a time
+    still gets `weight` times the share of a weight 1 tenant, and a small interactive request
+    is not stuck behind the hundreds of calls of a bulk job.
+    Callers are request threads (the pipeline endpoints are sync), they block on a shared threading.Condition.
+    """
+
+    def __init__(self, rates, default_rate=0.0, burst=1):
+        self.rates = rates
+        self.default_rate = default_rate
+        self.burst = burst
+        self.condition = threading.Condition()
+        self.sequence = count()  # breaks ties between equal tags in arrival order
+        self.hosts = {}  # host -> {"tokens", "updated", "virtual": tag of the last call sent, "finish": tenant -> tag of its next call, "queue": heap of (tag, sequence, ticket)}
+
+    def acquire(self, url, tenant, weight=1):
+        """
+        Block until the call may be sent, return the seconds waited.
+        """
+        host = urlparse(url).netloc
+        rate = self.rates.get(host, self.default_rate)
+        if rate <= 0:
+            return 0.0
+        start = time.monotonic()
+        ticket = object()
+        with self.condition:
+            state = self.hosts.setdefault(host, {"tokens": float(self.burst), "updated": start, "virtual": 0.0, "finish": {}, "queue": []})
+            tag = max(state["virtual"], state["finish"].get(tenant, 0.0))
+            state["finish"][tenant] = tag + 1 / weight
+            heapq.heappush(state["queue"], (tag, next(self.sequence), ticket))
+            while True:
+                now = time.monotonic()
+                state["tokens"] = min(self.burst, state["tokens"] + (now - state["updated"]) * rate)
+                state["updated"] = now
+                my_turn = state["queue"][0][2] is ticket
+                if my_turn and state["tokens"] >= 1:
+                    break
+                self.condition.wait((1 - state["tokens"]) / rate if my_turn else None)
+
+            state["tokens"] -= 1
+            heapq.heappop(state["queue"])
+            state["virtual"] = tag
+            # tenants whose next tag is behind the virtual time would start from it anyway
+            state["finish"] = {name: finish for name, finish in state["finish"].items() if finish > tag}
+            self.condition.notify_all()
+        return time.monotonic() - start
+
+class SingleFlight:
+    """
+    Coalesce concurrent identical calls: the first caller of a key runs it,
+    the others, from any thread, wait for it and share its result or exception.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}  # key -> [done Event, result, exception]
+
+    def do(self, key, function):
+        """
+        Return (result, shared), where shared tells whether the result came from another caller.
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = [threading.Event(), None, None]
+        if not leader:
+            call[0].wait()
+            if call[2] is not None:
+                raise call[2]
+            return call[1], True
+        try:
+            call[1] = function()
+        except BaseException as e:
+            call[2] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call[0].set()
+        return call[1], False
+
+upstream_flights = SingleFlight()
+upstream_scheduler = UpstreamScheduler(UPSTREAM_RATE_LIMITS, UPSTREAM_DEFAULT_RATE)
+upstream_tenant = ContextVar("upstream_tenant", default=("default", 1))  # (tenant, weight) of the request being served
+
+def archive_key(request):
+    """
+    Normalized description of an upstream request: method, URL without query,
+    then the query and form parameters sorted, whitespace collapsed and credentials dropped.
+    """
+    url = urlparse(request.url)
+    params = parse_qsl(url.query, keep_blank_values=True)
+    body = request.body
+    if isinstance(body, bytes):
+        body = body.decode("utf-8", errors="replace")
+    if body and request.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+        params += parse_qsl(body, keep_blank_values=True)
+        body = None
+    normalized = sorted((name, " ".join(value.split())) for name, value in params if name not in ARCHIVE_IGNORED_PARAMS)
+    key = f"{request.method} {url.scheme}://{url.netloc}{url.path}?{urlencode(normalized)}"
+    if body:
+        key += " " + hashlib.sha1(body.encode("utf-8")).hexdigest()
+    return key
+
+class ArchiveAdapter(requests.adapters.HTTPAdapter):
+    """
+    Transport adapter of the shared session that records every upstream response into a SQLite archive
+    (bodies zlib compressed), or replays them from it without network access.
+    """
+
+    def __init__(self, path, mode):
+        super().__init__()
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                status INTEGER,
+                reason TEXT,
+                headers TEXT,
+                body BLOB
+            )
+        """)
+
+    def send(self, request, **kwargs):
+        key = archive_key(request)
+        if self.mode == "replay":
+            with self.lock:
+                row = self.conn.execute("SELECT status, reason, headers, body FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                raise requests.ConnectionError(f"No archived response for {key}", request=request)
+            return self.archived_response(request, *row)
+
+        response = super().send(request, **kwargs)
+        # the body is stored decoded, so the transfer headers no longer apply
+        headers = {
+            name: value for name, value in response.headers.items()
+            if name.lower() not in ("content-encoding", "content-length", "transfer-encoding")
+        }
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, status, reason, headers, body) VALUES (?, ?, ?, ?, ?)",
+                (key, response.status_code, response.reason, json.dumps(headers), zlib.compress(response.content))
+            )
+            self.conn.commit()
+        return response
+
+    def archived_response(self, request, status, reason, headers, body):
+        response = requests.Response()
+        response.status_code = status
+        response.reason = reason
+        response.headers = requests.structures.CaseInsensitiveDict(json.loads(headers))
+        response._content = zlib.decompress(body)
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        return response
+
+http_session = requests.Session()  # keeps connections to the upstream services alive
+if HTTP_ARCHIVE_MODE:
+    archive_adapter = ArchiveAdapter(HTTP_ARCHIVE_PATH, HTTP_ARCHIVE_MODE)
+    http_session.mount("http://", archive_adapter)
+    http_session.mount("https://", archive_adapter)
+
+def upstream_request(upstream, method, url, **kwargs):
+    """
+    Send a request to an upstream service through the shared session.
+    Concurrent identical requests (same upstream, Accept header and normalized query) are sent once
+    and share the response, e.g. the Overpass relation of a place mentioned by several requests at the same time.
+    """
+    # a follower waits for the leader's call, including its place in the upstream scheduler:
+    # an interactive request joining a bulk job's call is served at the bulk job's priority
+    prepared = http_session.prepare_request(requests.Request(method, url, **kwargs))
+    key = (upstream, prepared.headers.get("Accept"), archive_key(prepared))
+    start = time.perf_counter()
+    response, shared = upstream_flights.do(key, lambda: send_upstream(upstream, method, url, **kwargs))
+    if shared:
+        elapsed = time.perf_counter() - start
+        UPSTREAM_COALESCED.labels(upstream).inc()
+        WAIT_SECONDS.labels("upstream_coalesced").inc(elapsed)
+        add_span("wait", "upstream_coalesced", elapsed)
+    return response
+
+def send_upstream(upstream, method, url, **kwargs):
+    """
+    Send a request to an upstream service through the shared session,
+    recording its latency and status (or 'error' if no response was received).
+    """
+    if HTTP_ARCHIVE_MODE != "replay":
+        waited = upstream_scheduler.acquire(url, *upstream_tenant.get())
+        if waited:
+            WAIT_SECONDS.labels("upstream_queue").inc(waited)
+            add_span("wait", "upstream_queue", waited)
+    start = time.perf_counter()
+    status = "error"
+    try:
+        response = http_session.request(method, url, **kwargs)
+        status = str(response.status_code)
+        return response
+    finally:
+        elapsed = time.perf_counter() - start
+        UPSTREAM_SECONDS.labels(upstream).observe(elapsed)
+        UPSTREAM_REQUESTS.labels(upstream, status).inc()
+        add_span("upstream", upstream, elapsed)
+
 
 # ======= Pydantic model =======
 class TextInput(BaseModel):
     text: str
     lang: Optional[str] = "en"
 
+class BatchInput(BaseModel):
+    documents: List[TextInput]
+
+
+# ======= Entity record =======
+class GeoEntity:
+    """
+    A resolved geographic entity.
+    The geometry is the shapely object shared with geometry_cache, WKT is rendered from it when serialized.
+    spans are the (start, end) character offsets of its mentions in the analyzed text.
+    """
+    __slots__ = ("label", "qid", "description", "osm_id", "geometry", "spans")
+
+    def __init__(self, label, qid, description, osm_id, geometry):
+        self.label = label
+        self.qid = qid
+        self.description = description
+        self.osm_id = osm_id
+        self.geometry = geometry
+        self.spans = []
+
+    @property
+    def wikidata_url(self):
+        return f"https://www.wikidata.org/wiki/{self.qid}"
+
+    def geometry_at(self, detail="full"):
+        """
+        The entity geometry at a level of detail, reusing the levels cached with it while geometry_cache holds the same geometry.
+        """
+        cached = geometry_cache.get(self.qid)
+        if cached is not None and cached["geometry"] is self.geometry:
+            return get_geometry_detail(cached, detail)
+        return derive_geometry(self.geometry, detail)
+
+    def as_wkt(self, detail="full"):
+        return wkt_literal(self.geometry_at(detail))
+
+    def __repr__(self):
+        return f"GeoEntity({self.label!r}, {self.qid!r})"
+
+
+# ======= Geometry cache =======
+class GeometryCache:
+    """
+    LRU cache of the resolved geometries by QID:
+    {"label": ..., "osm_id": ..., "geometry": full geometry, "levels": {detail: geometry}, "version": cache version}.
+    Entries resolved under an older cache version are dropped, and the least recently used ones beyond max_entries are evicted;
+    both change the places in the spatial index.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.version = None
+        self.lock = threading.Lock()
+
+    def get(self, qid):
+        version = get_cache_version()
+        with self.lock:
+            entry = self.entries.get(qid)
+            if entry is None:
+                return None
+            if entry["version"] == version:
+                self.entries.move_to_end(qid)
+                return entry
+            del self.entries[qid]  # upstream data refreshed since it was resolved
+        spatial_index.mark_dirty()
+        return None
+
+    def put(self, qid, entry):
+        with self.lock:
+            if entry["version"] != self.version:
+                self.version = entry["version"]
+                for outdated in [key for key, cached in self.entries.items() if cached["version"] != self.version]:
+                    del self.entries[outdated]
+            self.entries[qid] = entry
+            self.entries.move_to_end(qid)
+            while len(self.entries) > max(self.max_entries, 1):
+                self.entries.popitem(last=False)
+        spatial_index.mark_dirty()
+
+    def items(self):
+        with self.lock:
+            return list(self.entries.items())
+
+geometry_cache = GeometryCache(GEOMETRY_CACHE_SIZE)
+
+
+# ======= Resolution context =======
+class ResolutionContext:
+    """
+    Upstream lookups shared by the documents analyzed together,
+    so every text, entity name and QID is sent to Wikifier/Wikidata once per batch.
+    Geometries are shared through geometry_cache.
+    """
+
+    def __init__(self):
+        self.annotations = {}  # (text, lang) -> Wikifier annotations
+        self.searches = {}  # (entity text, lang) -> wbsearchentities result
+        self.geographic = {}  # QID -> is_geographic_entity result
+
+    def annotate(self, text, lang="en"):
+        key = (text, lang)
+        record_cache_lookup("wikifier", key in self.annotations)
+        if key not in self.annotations:
+            self.annotations[key] = disambiguation_with_wikifier(text, lang)
+        return self.annotations[key]
+
+    def search(self, entity_text, lang="en"):
+        key = (entity_text, lang)
+        if key not in self.searches:
+            self.searches[key] = fallback_wikidata_search(entity_text, lang)
+        return self.searches[key]
+
+    def is_geographic(self, qid):
+        record_cache_lookup("geographic_check", qid in self.geographic)
+        if qid not in self.geographic:
+            self.geographic[qid] = is_geographic_entity(qid)
+        return self.geographic[qid]
+
 
 # ======= Utility functions =======
 
@@ -108,21 +723,23 @@ def get_spacy_model(lang="en"):
         try:
             loaded_models[model_name] = spacy.load(model_name)
         except OSError:
-            print(f"⚠️ spaCy model '{model_name}' not found. Use fallback 'en_core_web_sm'.")
+            logger.warning("spaCy model not found, using en_core_web_sm", extra={"model": model_name})
             model_name = "en_core_web_sm"
             loaded_models[model_name] = spacy.load(model_name)
     return loaded_models[model_name]
 
+@stage("ner")
 def tokenize_text(text, lang="en"):
     nlp = get_spacy_model(lang)
     doc = nlp(text)
     return doc, nlp
 
 def extract_geo_entity(doc):
-    return [ent.text for ent in doc.ents if ent.label_ in ["LOC", "GPE", "NOUN", "PROPN"]]
+    return [ent for ent in doc.ents if ent.label_ in ["LOC", "GPE", "NOUN", "PROPN"]]
 
+@stage("wikifier")
 def disambiguation_with_wikifier(text, lang="en"):
-    url = "http://www.wikifier.org/annotate-article"
+    url = WIKIFIER_URL
     data = {
         "text": text,
         "lang": lang,
@@ -133,10 +750,11 @@ def disambiguation_with_wikifier(text, lang="en"):
         "filterCategories": "true",
         "threshold": "0.8",
     }
-    response = requests.post(url, data=data)
+    response = upstream_request("wikifier", "POST", url, data=data)
     response.raise_for_status()
     return response.json().get("annotations", [])
 
+@stage("geographic_check")
 def is_geographic_entity(qid):
     query = f"""
     ASK {{
@@ -144,56 +762,188 @@ def is_geographic_entity(qid):
       ?type wdt:P279* wd:Q618123 .
     }}
     """
-    url = "https://query.wikidata.org/sparql"
+    url = WIKIDATA_SPARQL_URL
     headers = {"Accept": "application/sparql-results+json"}
-    response = requests.get(url, params={"query": query}, headers=headers)
+    response = upstream_request("wikidata_sparql", "GET", url, params={"query": query}, headers=headers)
     response.raise_for_status()
     return response.json()['boolean']
 
+@stage("osm_lookup")
 def get_osm_relation_id(qid):
     query = f"""
     SELECT ?osmId WHERE {{
       wd:{qid} wdt:P402 ?osmId .
     }}
     """
-    url = "https://query.wikidata.org/sparql"
+    url = WIKIDATA_SPARQL_URL
     headers = {"Accept": "application/sparql-results+json"}
-    response = requests.get(url, params={"query": query}, headers=headers)
+    response = upstream_request("wikidata_sparql", "GET", url, params={"query": query}, headers=headers)
     response.raise_for_status()
     bindings = response.json()["results"]["bindings"]
     if bindings:
         return bindings[0]["osmId"]["value"]
     return None
 
+@stage("overpass")
 def get_geometry_from_osm(osm_id):
-    overpass_url = "https://overpass-api.de/api/interpreter"
+    """
+    Return the member ways of an OSM relation as NumPy arrays:
+    (coords, lengths, inner) where coords holds the (lon, lat) of all the ways one after the other,
+    lengths the number of points of each way and inner whether the way has the 'inner' role.
+    """
+    overpass_url = OVERPASS_URL
     query = f"""
     [out:json];
     relation({osm_id});
     out geom;
     """
-    response = requests.get(overpass_url, params={"data": query})
+    response = upstream_request("overpass", "GET", overpass_url, params={"data": query})
     response.raise_for_status()
     data = response.json()
-    coordinates = []
-    for element in data["elements"]:
-        for el in element:
-            if el == "members":
-                for e in element[el]:
-                    for prop in e:
-                        if prop == "geometry":
-                            coords = [(pt["lon"], pt["lat"]) for pt in e[prop]]
-                            if coords:
-                                coordinates.append(coords)
-    return coordinates
-
-def convert_to_vkt(coordinates):
-    from shapely.geometry import Polygon, MultiPolygon
-    polygons = [Polygon(coords) for coords in coordinates if len(coords) >= 3]
-    if not polygons:
+    ways = [
+        member
+        for element in data["elements"]
+        for member in element.get("members", [])
+        if member.get("type") == "way" and member.get("geometry")
+    ]
+    if not ways:
+        return None
+    lengths = np.fromiter((len(way["geometry"]) for way in ways), dtype=np.int64, count=len(ways))
+    lon_lat = itemgetter("lon", "lat")
+    coords = np.fromiter(
+        chain.from_iterable(chain.from_iterable(map(lon_lat, way["geometry"])) for way in ways),
+        dtype=np.float64,
+        count=2 * int(lengths.sum())
+    ).reshape(-1, 2)
+    inner = np.fromiter((way.get("role") == "inner" for way in ways), dtype=bool, count=len(ways))
+    return coords, lengths, inner
+
+def quantize_geometry(geometry):
+    """
+    Snap a geometry to the COORDINATE_PRECISION grid.
+    Snapping keeps the geometry valid and drops the meaningless digits from the WKT.
+    """
+    import shapely
+    snapped = shapely.set_precision(geometry, 10 ** -COORDINATE_PRECISION)
+    if shapely.is_empty(snapped):
+        return geometry  # collapsed on the grid, e.g. a tiny islet
+    if shapely.get_type_id(geometry) == shapely.GeometryType.MULTIPOLYGON:
+        snapped = shapely.multipolygons(shapely.get_parts(snapped))  # snapping may return a single Polygon
+    return snapped
+
+def open_local_store(path):
+    """
+    Open a read-only SQLite store built by one of the build_*.py scripts,
+    reopening it (and closing the previous connection) when the file has been replaced by a new build.
+    """
+    if not os.path.exists(path):
+        return None
+    mtime = os.path.getmtime(path)
+    with local_stores_lock:
+        opened = local_stores.get(path)
+        if opened is None or opened[1] != mtime:
+            connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+            if opened is not None:
+                opened[0].close()
+            local_stores[path] = opened = (connection, mtime)
+    return opened[0]
+
+def get_cache_version():
+    """
+    Stamp of the data behind pipeline results: DATA_VERSION plus the build time of the local stores.
+    It changes whenever the data is refreshed, which invalidates cached geometries and ETags.
+    """
+    parts = [DATA_VERSION]
+    for path in (GEONAMES_INDEX_PATH, OSM_STORE_PATH):
+        if os.path.exists(path):
+            parts.append(str(os.path.getmtime(path)))
+    return hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()[:12]
+
+def get_osm_store():
+    return open_local_store(OSM_STORE_PATH)
+
+@stage("osm_store")
+def get_geometry_from_store(osm_id):
+    """
+    Return the geometry of an OSM relation from the offline store,
+    or None if there is no store or the relation is not in it.
+    """
+    from shapely import from_wkb
+    store = get_osm_store()
+    if store is None:
+        return None
+    row = store.execute("SELECT wkb FROM relations WHERE id = ?", (int(osm_id),)).fetchone()
+    if row is None:
+        return None
+    return quantize_geometry(from_wkb(row[0]))
+
+@stage("wkt_conversion")
+def convert_to_geometry(ways):
+    """
+    Assemble the member ways returned by get_geometry_from_osm into a MultiPolygon.
+    Ways are joined into rings with polygonize, outer and inner roles separately,
+    then the inner rings are cut out of the outer ones.
+    """
+    import shapely
+    coords, lengths, inner = ways
+
+    valid = lengths >= 2
+    if not valid.any():
+        return None
+    coords = coords[np.repeat(valid, lengths)]
+    lengths, inner = lengths[valid], inner[valid]
+    lines = shapely.linestrings(coords, indices=np.repeat(np.arange(len(lengths)), lengths))
+
+    outer_polygons = shapely.get_parts(shapely.polygonize(lines[~inner]))
+    if not len(outer_polygons):
         return None
-    multi = MultiPolygon(polygons)
-    return multi.wkt
+    area = shapely.union_all(outer_polygons)
+
+    if inner.any():
+        holes = shapely.union_all(shapely.get_parts(shapely.polygonize(lines[inner])))
+        # outer rings lying inside a hole (islands in a lake) must survive the difference
+        islands = outer_polygons[shapely.contains_properly(holes, outer_polygons)]
+        area = shapely.union_all(np.append(islands, shapely.difference(area, holes)))
+
+    polygons = shapely.get_parts(area)
+    polygons = polygons[shapely.get_type_id(polygons) == shapely.GeometryType.POLYGON]
+    if not len(polygons):
+        return None
+    return quantize_geometry(shapely.multipolygons(polygons))
+
+def get_geometry_detail(cached, detail="full"):
+    """
+    Return the geometry of a geometry_cache entry at the requested level of detail.
+    Levels other than 'full' are computed once per QID and cached alongside the full geometry.
+    """
+    geometry = cached["geometry"]
+    if detail == "full" or geometry is None:
+        return geometry
+    levels = cached["levels"]
+    if detail not in levels:
+        levels[detail] = derive_geometry(geometry, detail)
+    return levels[detail]
+
+def derive_geometry(geometry, detail):
+    import shapely
+    if detail == "full" or geometry is None:
+        return geometry
+    if detail == "bbox":
+        derived = shapely.envelope(geometry)
+    elif detail == "centroid":
+        derived = shapely.centroid(geometry)
+    else:
+        derived = shapely.simplify(geometry, SIMPLIFY_TOLERANCES[detail], preserve_topology=True)
+    return quantize_geometry(derived)
+
+def wkt_literal(geometry):
+    """
+    Render a geometry as geo:wktLiteral. The text is not cached: it is written out as soon as it is built.
+    """
+    import shapely
+    with stage("wkt_conversion"):
+        wkt = shapely.to_wkt(geometry, rounding_precision=COORDINATE_PRECISION, trim=True)
+    return f"SRID=4326;{wkt}"
 
 #def save_geojson(file, filename="output.geojson"):
 #    features = []
@@ -229,9 +979,9 @@ def get_coordinates_from_wikidata(qid):
       wd:{qid} wdt:P625 ?coord .
     }}
     """
-    url = "https://query.wikidata.org/sparql"
+    url = WIKIDATA_SPARQL_URL
     headers = {"Accept": "application/sparql-results+json"}
-    response = requests.get(url, params={"query": query}, headers=headers)
+    response = upstream_request("wikidata_sparql", "GET", url, params={"query": query}, headers=headers)
     response.raise_for_status()
     coors_bindings = response.json()["results"]["bindings"]
     if coors_bindings:
@@ -250,7 +1000,7 @@ def fallback_wikidata_search(entity_text, lang="en"):
     similar to the website behavior.
     Returns the first result if available.
     """
-    url = "https://www.wikidata.org/w/api.php"
+    url = WIKIDATA_API_URL
     params = {
         "action": "wbsearchentities",
         "search": entity_text,
@@ -259,7 +1009,7 @@ def fallback_wikidata_search(entity_text, lang="en"):
         "limit": 1
     }
 
-    response = requests.get(url, params=params)
+    response = upstream_request("wikidata_api", "GET", url, params=params)
     response.raise_for_status()
     data = response.json()
 
@@ -277,6 +1027,8 @@ def segment_by_language(text, nlp):
     segments = []
     current_lang = None
     current_block = []
+    current_offsets = []  # (offset in the segment text, offset in text) of each sentence of the block
+    block_length = 0
 
     if "sentencizer" not in nlp.pipe_names:
         nlp.add_pipe("sentencizer")
@@ -289,201 +1041,295 @@ def segment_by_language(text, nlp):
             continue
 
         try:
-            lang = detect(sent_text)
+            with stage("language_detection"):
+                lang = detect(sent_text)
         except:
             lang = "en"  # fallback
 
+        sent_start = sent.start_char + len(sent.text) - len(sent.text.lstrip())
         if lang != current_lang:
             if current_block:
                 segments.append({
                     "lang": current_lang,
-                    "text": " ".join(current_block)
+                    "text": " ".join(current_block),
+                    "offsets": current_offsets
                 })
             current_block = [sent_text]
+            current_offsets = [(0, sent_start)]
+            block_length = len(sent_text)
             current_lang = lang
         else:
+            current_offsets.append((block_length + 1, sent_start))
+            block_length += 1 + len(sent_text)
             current_block.append(sent_text)
 
     if current_block:
         segments.append({
             "lang": current_lang,
-            "text": " ".join(current_block)
+            "text": " ".join(current_block),
+            "offsets": current_offsets
         })
 
     return segments
 
-def retrieve_geometry(annotation, label, qid, entities, processed_qids, only_geometry):
+def segment_to_text_offset(offsets, position):
+    """
+    Map a character offset in a segment built by segment_by_language to the text it was built from.
+    """
+    segment_start, text_start = offsets[bisect_right(offsets, (position, math.inf)) - 1]
+    return text_start + position - segment_start
+
+def record_spans(annotations, spans, to_text=lambda position: position):
+    """
+    Collect the character offsets of the mentions of each annotated QID from the Wikifier support
+    (chTo is the last character, the recorded end is exclusive), mapped to the analyzed text by to_text.
+    """
+    for annotation in annotations:
+        qid = annotation.get("wikiDataItemId")
+        if not qid:
+            continue
+        for support in annotation.get("support", []):
+            if "chFrom" in support and "chTo" in support:
+                spans.setdefault(qid, set()).add((to_text(support["chFrom"]), to_text(support["chTo"]) + 1))
+
+def retrieve_geometry(annotation, label, qid, entities, processed_qids, only_geometry, context=None):
     try:
         if not only_geometry:
-            if annotation.get("cosine", 1.0) < 0.5 or not is_geographic_entity(qid):
+            is_geographic = context.is_geographic if context else is_geographic_entity
+            if annotation.get("cosine", 1.0) < 0.5 or not is_geographic(qid):
                 return
         else:
             if qid in processed_qids:
-                print(f"\n⚠️ Skipping {qid}, already processed.")
+                pipeline_logger.debug("Skipping entity, already processed", extra={"qid": qid, "sampled": True})
                 return
-        print(f"\n🔍 Entity check: {label} ({qid})...")
-        osm_id = get_osm_relation_id(qid)
-        print(f"✔️ It is geographic - OSM ID: {osm_id}")
-        vkt = None
-        if osm_id:
-            coords = get_geometry_from_osm(osm_id)
-            if coords:
-                vkt = convert_to_vkt(coords)
-            else:
-                print("⚠️ No OSM geometry found. Trying with coordinates...")
-        if not vkt:
-            coords_point = get_coordinates_from_wikidata(qid)
-            if coords_point:
-                lat, lon = coords_point
-                vkt = f"POINT ({lon} {lat})"
-                print(f"📍 Coordinates found: {lat}, {lon}")
-                print(f"📍 VKT: {vkt[:80]}..." if vkt else "⚠️ No valid geometry.")
+        cached = geometry_cache.get(qid)
+        record_cache_lookup("geometry", cached is not None)
+        if cached:
+            osm_id, geometry = cached["osm_id"], cached["geometry"]
+            pipeline_logger.info("Geometry already retrieved", extra={"label": label, "qid": qid, "sampled": True})
         else:
-            geom_type = vkt.split()[0]
-            print(f"📐 Geometry type: {geom_type}")
+            osm_id = get_osm_relation_id(qid)
+            pipeline_logger.info("Geographic entity", extra={"label": label, "qid": qid, "osm_id": osm_id, "sampled": True})
+            geometry = None
+            if osm_id:
+                geometry = get_geometry_from_store(osm_id)
+                if geometry is None:
+                    ways = get_geometry_from_osm(osm_id)
+                    if ways:
+                        geometry = convert_to_geometry(ways)
+                    else:
+                        pipeline_logger.warning("No OSM geometry found, trying with coordinates", extra={"qid": qid, "osm_id": osm_id})
+            if geometry is None:
+                coords_point = get_coordinates_from_wikidata(qid)
+                if coords_point:
+                    lat, lon = coords_point
+                    geometry = quantize_geometry(Point(lon, lat))
+                    pipeline_logger.info("Coordinates found", extra={"qid": qid, "lat": lat, "lon": lon, "sampled": True})
+                else:
+                    pipeline_logger.warning("No valid geometry", extra={"label": label, "qid": qid})
+            else:
+                pipeline_logger.info("Geometry found", extra={"qid": qid, "geometry_type": geometry.geom_type, "sampled": True})
+            geometry_cache.put(qid, {"label": label, "osm_id": osm_id, "geometry": geometry, "levels": {}, "version": get_cache_version()})
 
         if not only_geometry:
             description = annotation.get("description")
         else:
             description = ""
 
-        entities.append({
-            "label": label,
-            "qid": qid,
-            "description": description,
-            "wikidata_url": f"https://www.wikidata.org/wiki/{qid}",
-            "osm_id": osm_id,
-            "vkt": vkt,
-            "wkt": f"SRID=4326;{vkt}"  # compliant with geo:wktLiteral
-        })
+        entities.append(GeoEntity(label, qid, description, osm_id, geometry))
 
         if not only_geometry:
             processed_qids.add(qid)
 
-        time.sleep(4)  # Avoid rate limit
+        if not cached:
+            wait(RATE_LIMIT_DELAY, "rate_limit")  # Avoid rate limit
 
         if only_geometry:
             return entities
 
     except Exception as e:
-        print(f"❌ Error with {label}: {e}")
-        print("Retrying...")
-        time.sleep(10)
-        retrieve_geometry(annotation, label, qid, entities, processed_qids, only_geometry)
+        pipeline_logger.error("Geometry retrieval failed, retrying", extra={"label": label, "qid": qid, "error": str(e)})
+        RETRIES.labels("retrieve_geometry").inc()
+        wait(RETRY_DELAY, "retry")
+        retrieve_geometry(annotation, label, qid, entities, processed_qids, only_geometry, context)
 
-def process_annotation(annotation, processed_qids, entities):
+def process_annotation(annotation, processed_qids, entities, context):
     try:
         qid = annotation["wikiDataItemId"]
         label = annotation["title"]
     except KeyError as e:
-        print(f"\n⚠️ Warning. The key {e} is missing from the annotation '{annotation['title']}'.")
+        pipeline_logger.warning("Key missing from the annotation", extra={"key": str(e), "title": annotation.get("title")})
         return
 
     if qid in processed_qids:
         return
 
-    retrieve_geometry(annotation, label, qid, entities, processed_qids, False)
+    retrieve_geometry(annotation, label, qid, entities, processed_qids, False, context)
 
-def analyze(annotation_text, entities, processed_qids):
+def analyze(annotation_text, entities, processed_qids, context):
     for ann in annotation_text:
-        process_annotation(ann, processed_qids, entities)
+        process_annotation(ann, processed_qids, entities, context)
 
-def detect_spacy_and_fallback(entities_spacy, processed_qids, entities, lg, to_detect):
-    for ent_text in entities_spacy:
+def detect_spacy_and_fallback(entities_spacy, processed_qids, entities, lg, to_detect, context, spans):
+    for ent in entities_spacy:
+        ent_text = ent.text
 
         if to_detect:
             try:
-                lg = detect(ent_text)
+                with stage("language_detection"):
+                    lg = detect(ent_text)
             except:
                 lg = "en"  # fallback
 
-        ent_annotations = disambiguation_with_wikifier(ent_text, lg)
+        ent_annotations = context.annotate(ent_text, lg)
         if not ent_annotations:
-            print(f"\n⚠️ No annotations from Wikifier for: '({lg}) {ent_text}', trying fallback...")
-            fallback_result = fallback_wikidata_search(ent_text, lg)
+            pipeline_logger.info("No annotations from Wikifier, trying the Wikidata search", extra={"text": ent_text, "lang": lg, "sampled": True})
+            fallback_result = context.search(ent_text, lg)
             if fallback_result:
-                process_annotation(fallback_result, processed_qids, entities)
+                spans.setdefault(fallback_result["wikiDataItemId"], set()).add((ent.start_char, ent.end_char))
+                process_annotation(fallback_result, processed_qids, entities, context)
 
         else:
+            record_spans(ent_annotations, spans, lambda position: ent.start_char + position)
             for ann in ent_annotations:
-                process_annotation(ann, processed_qids, entities)
+                process_annotation(ann, processed_qids, entities, context)
+
+def analyze_text(text, lang="en", context=None):
+    """
+    Resolve the geographic entities of a text.
+    Pass the same ResolutionContext to analyze several texts without repeating upstream lookups.
+    The spans of each entity are the offsets of its mentions in text.
+    """
+    if context is None:
+        context = ResolutionContext()
 
-def analyze_text(text, lang="en"):
     doc, nlp = tokenize_text(text, lang=lang)
     entities_spacy = extract_geo_entity(doc)
-    print(f"\nEntities found by spaCy: {', '.join(entities_spacy)}")
+    pipeline_logger.info("Entities found by spaCy", extra={"entities": [ent.text for ent in entities_spacy], "lang": lang})
 
     entities = []
     processed_qids = set()
+    spans = {}  # QID -> {(start, end)} in text
 
     # workflow: Wikifier disambiguation of the entities found by spaCy and then repeat the disambiguation of all the text by Wikifier
     # the difference between mixed language and a single one is that in the first case we need to detect the language of each phrase
     if lang == "xx":
 
-        detect_spacy_and_fallback(entities_spacy, processed_qids, entities, lang, to_detect=True)
+        detect_spacy_and_fallback(entities_spacy, processed_qids, entities, lang, to_detect=True, context=context, spans=spans)
 
         # then try again and leave to Wikifier all the tasks
         multilingual_segments = segment_by_language(text, nlp)
 
         for segment in multilingual_segments:
             entities_temp = []
-            annotations = disambiguation_with_wikifier(segment['text'], lang=segment['lang'])
-            analyze(annotations, entities_temp, processed_qids)
+            annotations = context.annotate(segment['text'], lang=segment['lang'])
+            record_spans(annotations, spans, lambda position, offsets=segment['offsets']: segment_to_text_offset(offsets, position))
+            analyze(annotations, entities_temp, processed_qids, context)
             entities.extend(entities_temp)
 
     else:
-        detect_spacy_and_fallback(entities_spacy, processed_qids, entities, lang, to_detect=False)
-        annotations = disambiguation_with_wikifier(text, lang)
-        analyze(annotations, entities, processed_qids)
+        detect_spacy_and_fallback(entities_spacy, processed_qids, entities, lang, to_detect=False, context=context, spans=spans)
+        annotations = context.annotate(text, lang)
+        record_spans(annotations, spans)
+        analyze(annotations, entities, processed_qids, context)
 
+    for entity in entities:
+        entity.spans = sorted(spans.get(entity.qid, ()))
     return entities
 
 def perform_sparql_query(query: str):
-    endpoint = "https://query.wikidata.org/sparql"
+    endpoint = WIKIDATA_SPARQL_URL
     headers = {
         "Accept": "application/sparql-results+json"
     }
-    response = requests.get(endpoint, params={"query": query}, headers=headers)
+    response = upstream_request("wikidata_sparql", "GET", endpoint, params={"query": query}, headers=headers)
     if response.status_code == 200:
         return response.json().get("results", {}).get("bindings", [])
     else:
         return []
 
 
-def get_wikipedia_article_from_geonames(geonames_iri):
-    rdf_url = geonames_iri.rstrip('/') + '/about.rdf'
-    response = requests.get(rdf_url)
+def get_geonames_index():
+    return open_local_store(GEONAMES_INDEX_PATH)
+
+def lookup_geonames_index(geonames_id):
+    """
+    Return (name, wikipedia_url) from the local GeoNames index,
+    or None if there is no index or the id is not in it.
+    """
+    index = get_geonames_index()
+    if index is None:
+        return None
+    return index.execute("SELECT name, wikipedia_url FROM geonames WHERE id = ?", (int(geonames_id),)).fetchone()
+
+def get_geonames_rdf(geonames_id):
+    """
+    Return (name, wikipedia_url) from about.rdf of a GeoNames id, like lookup_geonames_index,
+    or None on a transient error. Only these two fields are kept, in a bounded LRU cache.
+    """
+    with geonames_rdf_lock:
+        record = geonames_rdf_cache.get(geonames_id)
+        if record is not None:
+            geonames_rdf_cache.move_to_end(geonames_id)
+    record_cache_lookup("geonames_rdf", record is not None)
+    if record is not None:
+        return record
+
+    rdf_url = GEONAMES_RDF_URL.format(id=geonames_id)
+    response = upstream_request("geonames", "GET", rdf_url)
 
     if response.status_code == 200:
-        root = ET.fromstring(response.content)
         ns = {
             'gn': 'http://www.geonames.org/ontology#',
             'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#'
         }
-
+        root = ET.fromstring(response.content)
+        label_elem = root.find('.//gn:name', ns)
+        name = label_elem.text if label_elem is not None and label_elem.text else None
+        wikipedia_url = None
         for wiki_elem in root.findall('.//gn:wikipediaArticle', ns):
             url = wiki_elem.attrib.get('{http://www.w3.org/1999/02/22-rdf-syntax-ns#}resource')
             if url and 'en.wikipedia.org' in url:
-                return url
+                wikipedia_url = url
+                break
+        record = (name, wikipedia_url)
+    elif response.status_code == 404:
+        record = (None, None)
+    else:
+        return None  # do not cache transient errors
+
+    if GEONAMES_RDF_CACHE_SIZE > 0:
+        with geonames_rdf_lock:
+            geonames_rdf_cache[geonames_id] = record
+            geonames_rdf_cache.move_to_end(geonames_id)
+            while len(geonames_rdf_cache) > GEONAMES_RDF_CACHE_SIZE:
+                geonames_rdf_cache.popitem(last=False)
+    return record
+
+def get_wikipedia_article_from_geonames(geonames_iri):
+    match = re.search(r'/(\d+)', geonames_iri)
+    if not match:
+        return None
+    geonames_id = match.group(1)
+
+    row = lookup_geonames_index(geonames_id)
+    if row is not None:
+        return row[1]
+
+    record = get_geonames_rdf(geonames_id)
+    if record is not None:
+        return record[1]
 
     return None
 
 def get_geonames_label(geonames_id):
-    #rdf_url = geonames_iri.rstrip('/') + '/about.rdf'
-    rdf_url = f"https://www.geonames.org/{geonames_id}/about.rdf"
-    response = requests.get(rdf_url)
-
-    if response.status_code == 200:
-        root = ET.fromstring(response.content)
-        ns = {
-            'gn': 'http://www.geonames.org/ontology#',
-            'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
-            'rdfs': 'http://www.w3.org/2000/01/rdf-schema#'
-        }
+    row = lookup_geonames_index(geonames_id)
+    if row is not None and row[0]:
+        return row[0]
 
-        label_elem = root.find('.//gn:name', ns)
-        if label_elem is not None and label_elem.text:
-            return label_elem.text
+    record = get_geonames_rdf(geonames_id)
+    if record is not None:
+        return record[0]
 
     return None
 
@@ -491,7 +1337,7 @@ def get_wikidata_entity_from_wikipedia_url(wikipedia_url: str, language: str = "
     parsed_url = urlparse(wikipedia_url)
     title = unquote(parsed_url.path.split("/wiki/")[-1])
 
-    wiki_api_url = f"https://{parsed_url.hostname}/w/api.php"
+    wiki_api_url = WIKIPEDIA_API_URL.format(host=parsed_url.hostname)
     params = {
         "action": "query",
         "titles": title,
@@ -504,7 +1350,7 @@ def get_wikidata_entity_from_wikipedia_url(wikipedia_url: str, language: str = "
     }
 
     try:
-        response = requests.get(wiki_api_url, params=params, headers=headers)
+        response = upstream_request("wikipedia", "GET", wiki_api_url, params=params, headers=headers)
 
         if response.status_code == 429:
             raise WikipediaRateLimitException("Rate limit exceeded (HTTP 429). Try again later.")
@@ -522,7 +1368,7 @@ def get_wikidata_entity_from_wikipedia_url(wikipedia_url: str, language: str = "
         for page in pages.values():
             wikidata_id = page.get("pageprops", {}).get("wikibase_item")
             if wikidata_id:
-                wikidata_api_url = "https://www.wikidata.org/w/api.php"
+                wikidata_api_url = WIKIDATA_API_URL
                 label_params = {
                     "action": "wbgetentities",
                     "ids": wikidata_id,
@@ -530,7 +1376,7 @@ def get_wikidata_entity_from_wikipedia_url(wikipedia_url: str, language: str = "
                     "props": "labels",
                     "languages": language
                 }
-                wd_response = requests.get(wikidata_api_url, params=label_params, headers=headers)
+                wd_response = upstream_request("wikidata_api", "GET", wikidata_api_url, params=label_params, headers=headers)
                 wd_response.raise_for_status()
                 wd_data = wd_response.json()
 
@@ -547,7 +1393,7 @@ import requests
 
 
 def search_wikidata_entity(query, language='en'):
-    url = "https://www.wikidata.org/w/api.php"
+    url = WIKIDATA_API_URL
     params = {
         "action": "wbsearchentities",
         "format": "json",
@@ -557,7 +1403,7 @@ def search_wikidata_entity(query, language='en'):
     }
 
     try:
-        response = requests.get(url, params=params)
+        response = upstream_request("wikidata_api", "GET", url, params=params)
         response.raise_for_status()
         results = response.json().get("search", [])
 
@@ -571,14 +1417,1212 @@ def search_wikidata_entity(query, language='en'):
                 }
 
     except requests.RequestException as e:
-        print(f"\n⚠️ Wikidata query error : {e}")
+        logger.warning("Wikidata query error", extra={"error": str(e)})
 
     return None
 
+# ======= Output writers =======
+
+class JSONLDResponse(Response):
+    """
+    JSON-LD response serialized with orjson, compact unless pretty-printing is requested.
+    """
+    media_type = "application/ld+json"
+
+    def __init__(self, content, pretty=False, **kwargs):
+        self.pretty = pretty
+        super().__init__(content, **kwargs)
+
+    def render(self, content):
+        return dump_jsonld(content, self.pretty)
+
+@stage("serialization")
+def dump_jsonld(document, pretty=False):
+    return orjson.dumps(document, option=orjson.OPT_INDENT_2 if pretty else 0)
+
+def get_context_url(request):
+    if GEOSPARQL_CONTEXT_URL:
+        return GEOSPARQL_CONTEXT_URL
+    return str(request.url_for("geosparql_context"))
+
+def build_geometry(entity, detail="full"):
+    return {
+        "@id": f"wd:{entity.qid}-geom",
+        "@type": "Geometry",
+        "asWKT": entity.as_wkt(detail)
+    }
+
+def build_feature(entity, detail="full", embed_geometry=True):
+    """
+    GeoSPARQL Feature of a resolved entity, with its Geometry at the requested level of detail
+    or only a reference to it when the geometries are listed separately.
+    """
+    feature_id = f"wd:{entity.qid}"
+    feature = {
+        "@id": feature_id,
+        "@type": "Feature",
+        "label": entity.label,
+        "description": entity.description,
+        "qid": entity.qid,
+        "wikidata": entity.wikidata_url,
+        "osm_id": entity.osm_id,
+        "hasGeometry": build_geometry(entity, detail) if embed_geometry else {"@id": f"{feature_id}-geom"}
+    }
+    return feature
+
+def iter_jsonld(context_url, features, pretty=False):
+    """
+    Serialize a JSON-LD document feature by feature, so downloads are streamed while the graph is built.
+    """
+    if pretty:
+        yield dump_jsonld({"@context": context_url, "@graph": list(features)}, pretty=True)
+        return
+    yield b'{"@context":' + orjson.dumps(context_url) + b',"@graph":['
+    elapsed = 0.0
+    for i, feature in enumerate(features):
+        start = time.perf_counter()
+        chunk = orjson.dumps(feature)
+        elapsed += time.perf_counter() - start
+        yield (b"," if i else b"") + chunk
+    observe_stage("serialization", elapsed)
+    yield b"]}"
+
+def build_mentions(entity, literal_index):
+    """
+    Where a feature is mentioned: index of the literal and character offsets of each mention
+    in its whitespace-stripped text, as found by Wikifier or spaCy (a single record with null offsets if unknown).
+    """
+    spans = entity.spans or [(None, None)]
+    return [
+        {
+            "@type": "Mention",
+            "about": {"@id": f"wd:{entity.qid}"},
+            "literal": literal_index,
+            "start": start,
+            "end": end
+        }
+        for start, end in spans
+    ]
+
+def record_qids(features, qids):
+    for feature in features:
+        if "qid" in feature:
+            qids.append(feature["qid"])
+        yield feature
+
+def attachment_headers(extension):
+    return {"Content-Disposition": f'attachment; filename="geosparql_{uuid4().hex}.{extension}"'}
+
+def geosparql_response(features, request, download=False, pretty=False, persist=False):
+    """
+    JSON-LD document referencing the GeoSPARQL @context,
+    inline, streamed as a downloadable .jsonld file or persisted as an artifact.
+    """
+    context_url = get_context_url(request)
+
+    if persist:
+        qids = []
+        artifact_id = artifact_spool.put(iter_jsonld(context_url, record_qids(features, qids), pretty), "jsonld", qids)
+        return artifact_response(artifact_id, download)
+
+    if not download:
+        return JSONLDResponse({"@context": context_url, "@graph": list(features)}, pretty=pretty)
+
+    return StreamingResponse(
+        iter_jsonld(context_url, features, pretty),
+        media_type="application/ld+json",
+        headers=attachment_headers("jsonld")
+    )
+
+def batch_graph(documents, detail="full"):
+    """
+    JSON-LD graph of a batch: one Document node per input text, whose features reference
+    the Geometry nodes listed once after them, however many documents mention the same place.
+    """
+    geometries = {}
+    for index, (lang, entities) in enumerate(documents):
+        for entity in entities:
+            if entity.qid not in geometries:
+                geometries[entity.qid] = entity
+        yield {
+            "@id": f"_:doc{index}",
+            "@type": "Document",
+            "index": index,
+            "lang": lang,
+            "mentions": [build_feature(entity, detail, embed_geometry=False) for entity in entities]
+        }
+    for entity in geometries.values():
+        yield build_geometry(entity, detail)
+
+def write_ndjson(entities, detail="full"):
+    """
+    One JSON object per line, with the geometry as base64 WKB.
+    """
+    import shapely
+    lines = []
+    for entity in entities:
+        wkb = shapely.to_wkb(entity.geometry_at(detail))
+        lines.append(orjson.dumps({
+            "qid": entity.qid,
+            "label": entity.label,
+            "description": entity.description,
+            "wikidata": entity.wikidata_url,
+            "osm_id": entity.osm_id,
+            "wkb": base64.b64encode(wkb).decode("ascii")
+        }))
+    return b"".join(line + b"\n" for line in lines)
+
+def write_geoparquet(entities, detail="full"):
+    """
+    GeoParquet 1.0 file with a WKB 'geometry' column (lon/lat, OGC:CRS84), zstd compressed.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import shapely
+    geometries = np.array([entity.geometry_at(detail) for entity in entities], dtype=object)
+    table = pa.table({
+        "qid": [entity.qid for entity in entities],
+        "label": [entity.label for entity in entities],
+        "description": [entity.description for entity in entities],
+        "wikidata": [entity.wikidata_url for entity in entities],
+        "osm_id": [entity.osm_id for entity in entities],
+        "geometry": pa.array(shapely.to_wkb(geometries), type=pa.binary()),
+    })
+    column = {
+        "encoding": "WKB",
+        "geometry_types": sorted({geometry.geom_type for geometry in geometries}),
+    }
+    if len(geometries):
+        column["bbox"] = shapely.total_bounds(geometries).tolist()
+    geo_metadata = {"version": "1.0.0", "primary_column": "geometry", "columns": {"geometry": column}}
+    table = table.replace_schema_metadata({b"geo": json.dumps(geo_metadata).encode("utf-8")})
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, compression="zstd")
+    return buffer.getvalue()
+
+def write_flatgeobuf(entities, detail="full"):
+    """
+    FlatGeobuf file with a packed Hilbert R-tree, so clients can stream it and read by bbox.
+    """
+    import pyogrio.raw
+    import shapely
+    geometries = np.array([entity.geometry_at(detail) for entity in entities], dtype=object)
+    fields = ["qid", "label", "description", "wikidata", "osm_id"]
+    field_data = [
+        np.array([entity.qid for entity in entities], dtype=object),
+        np.array([entity.label for entity in entities], dtype=object),
+        np.array([entity.description for entity in entities], dtype=object),
+        np.array([entity.wikidata_url for entity in entities], dtype=object),
+        np.array([entity.osm_id for entity in entities], dtype=object),
+    ]
+    buffer = io.BytesIO()
+    pyogrio.raw.write(
+        buffer, shapely.to_wkb(geometries), field_data, fields,
+        layer="features", driver="FlatGeobuf", geometry_type="Unknown", crs="EPSG:4326",
+        layer_options={"SPATIAL_INDEX": "YES"}
+    )
+    return buffer.getvalue()
+
+OUTPUT_WRITERS = {
+    "geoparquet": write_geoparquet,
+    "flatgeobuf": write_flatgeobuf,
+    "ndjson": write_ndjson,
+}
+
+def write_output(entities, output_format, detail="full", download=False, persist=False):
+    """
+    Serialize the resolved entities with one of the binary/line writers.
+    JSON-LD is built by the endpoints with GEOSPARQL_CONTEXT.
+    """
+    media_type, extension = OUTPUT_FORMATS[output_format]
+    with stage("serialization"):
+        content = OUTPUT_WRITERS[output_format](entities, detail)
+    if persist:
+        artifact_id = artifact_spool.put([content], extension, [entity.qid for entity in entities])
+        return artifact_response(artifact_id, download)
+    headers = attachment_headers(extension) if download else {}
+    return Response(content=content, media_type=media_type, headers=headers)
+
+
+# ======= Artifacts =======
+
+def artifact_places(qids):
+    """
+    Lines of the places sidecar of an artifact: label, OSM id and WKB geometry of each of its QIDs,
+    so its vector tiles are served from the sidecar, after a restart too.
+    """
+    import shapely
+    for qid in dict.fromkeys(qids):
+        cached = geometry_cache.get(qid)
+        if cached is None or cached["geometry"] is None:
+            continue
+        yield orjson.dumps({
+            "qid": qid,
+            "label": cached["label"],
+            "osm_id": cached["osm_id"],
+            "wkb": base64.b64encode(shapely.to_wkb(cached["geometry"])).decode("ascii")
+        }) + b"\n"
+
+class ArtifactSpool:
+    """
+    Directory of persisted results (e.g. bulk job outputs) with a size quota and TTL-based eviction.
+    Expired artifacts are removed, then the oldest ones until the directory fits in the quota.
+    Next to each artifact, a <id>.places sidecar keeps the geometries of its features for the vector tiles;
+    it is evicted with the artifact.
+    """
+
+    def __init__(self, directory, ttl, max_bytes):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.evict()
+
+    def put(self, chunks, extension, qids=None):
+        artifact_id = uuid4().hex
+        path = os.path.join(self.directory, f"{artifact_id}.{extension}")
+        partial = path + ".part"
+        with open(partial, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        if qids is not None:  # written once the chunks are consumed, as they may fill qids
+            places = os.path.join(self.directory, f"{artifact_id}.places")
+            with open(places + ".part", "wb") as f:
+                f.writelines(artifact_places(qids))
+            os.replace(places + ".part", places)
+        os.replace(partial, path)
+        self.evict(keep=artifact_id)
+        return artifact_id
+
+    def find(self, artifact_id, extension=None):
+        """
+        Path of an artifact (or of its file with the given extension), None if missing or expired.
+        """
+        if not re.fullmatch(r"[0-9a-f]{32}", artifact_id):
+            return None
+        for name in os.listdir(self.directory):
+            if not name.startswith(artifact_id + ".") or name.endswith(".part"):
+                continue
+            if (name.endswith(".places")) != (extension == "places"):
+                continue
+            path = os.path.join(self.directory, name)
+            if time.time() - os.path.getmtime(path) <= self.ttl:
+                return path
+        return None
+
+    def evict(self, keep=None):
+        with self.lock:
+            now = time.time()
+            artifacts = {}  # artifact id -> [mtime, size, paths] of the artifact and its sidecar
+            for entry in os.scandir(self.directory):
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+                if now - stat.st_mtime > self.ttl:
+                    os.remove(entry.path)
+                elif not entry.name.endswith(".part"):
+                    artifact = artifacts.setdefault(entry.name.split(".", 1)[0], [0.0, 0, []])
+                    artifact[0] = max(artifact[0], stat.st_mtime)
+                    artifact[1] += stat.st_size
+                    artifact[2].append(entry.path)
+            total = sum(size for _, size, _ in artifacts.values())
+            for artifact_id, (_, size, paths) in sorted(artifacts.items(), key=lambda item: item[1][0]):
+                if total <= self.max_bytes:
+                    break
+                if artifact_id != keep:
+                    for path in paths:
+                        os.remove(path)
+                    total -= size
+
+artifact_spool = ArtifactSpool(ARTIFACT_DIR, ARTIFACT_TTL, ARTIFACT_MAX_BYTES)
+
+def artifact_response(artifact_id, download=False):
+    path = artifact_spool.find(artifact_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Artifact not found or expired.")
+    extension = path.rsplit(".", 1)[-1]
+    media_type = next(media for media, ext in OUTPUT_FORMATS.values() if ext == extension)
+    headers = {"Content-Location": f"/artifacts/{artifact_id}"}
+    if download:
+        headers.update(attachment_headers(extension))
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+
+# ======= Response cache =======
+
+class ResponseCache:
+    """
+    LRU cache of rendered responses, keyed by endpoint, parameters, input hash and cache version.
+    Each entry keeps the identity body and the compressed variants already sent.
+    """
+
+    def __init__(self, max_entries, max_body_bytes):
+        self.max_entries = max_entries
+        self.max_body_bytes = max_body_bytes
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        if self.max_entries <= 0 or len(entry["body"]) > self.max_body_bytes:
+            return
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_MAX_BYTES)
+
+def response_cache_key(request, payload=b""):
+    """
+    Canonical key of a request: endpoint, sorted query parameters, hash of the input and cache version.
+    """
+    params = urlencode(sorted(request.query_params.multi_items()))
+    digest = hashlib.sha256(payload).hexdigest()
+    return f"{request.url.path}?{params}#{digest}@{get_cache_version()}"
+
+def make_etag(key):
+    """
+    Weak ETag of a request key: the same for every content coding, and streamed bodies
+    are not known when the headers are sent, so it only vouches for an equivalent result.
+    """
+    return 'W/"' + hashlib.sha256(key.encode("utf-8")).hexdigest()[:32] + '"'
+
+def etag_matches(request, etag):
+    """
+    Weak comparison, as If-None-Match requires.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in candidates or etag.removeprefix("W/") in candidates
+
+def choose_encoding(request):
+    """
+    Negotiate the response compression from Accept-Encoding, brotli first, then gzip.
+    """
+    accepted = {}
+    for item in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    quality = {encoding: accepted.get(encoding, accepted.get("*", 0.0)) for encoding in ("br", "gzip")}
+    encoding = max(quality, key=quality.get)  # brotli wins ties
+    return encoding if quality[encoding] > 0 else None
+
+def compress_body(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+async def compress_stream(chunks, encoding):
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        compress, finish = compressor.process, compressor.finish
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip container
+        compress, finish = compressor.compress, compressor.flush
+    async for chunk in chunks:
+        compressed = compress(chunk)
+        if compressed:
+            yield compressed
+    yield finish()
+
+COMPRESSIBLE_MEDIA_TYPES = ("application/ld+json", "application/x-ndjson", "application/json")
+
+async def iter_file(path, chunk_size=64 * 1024):
+    with open(path, "rb") as f:
+        while chunk := await run_in_threadpool(f.read, chunk_size):
+            yield chunk
+
+def compress_response(request, response):
+    """
+    Apply the negotiated encoding to a JSON(-LD) or NDJSON response that is not cached:
+    in-memory bodies are compressed at once, files (persisted artifacts) while they are sent.
+    """
+    if response.status_code != 200 or response.media_type not in COMPRESSIBLE_MEDIA_TYPES:
+        return response
+    response.headers["Vary"] = "Accept-Encoding"
+    if isinstance(response, FileResponse):
+        size = os.path.getsize(response.path)
+    elif isinstance(response, StreamingResponse):
+        return response
+    else:
+        size = len(response.body)
+    encoding = choose_encoding(request) if size >= COMPRESSION_MIN_SIZE else None
+    if encoding is None:
+        return response
+    headers = {
+        name: value for name, value in response.headers.items()
+        if name not in ("content-length", "content-type")
+    }
+    headers["Content-Encoding"] = encoding
+    if isinstance(response, FileResponse):
+        return StreamingResponse(compress_stream(iter_file(response.path), encoding), media_type=response.media_type, headers=headers)
+    return Response(content=compress_body(response.body, encoding), media_type=response.media_type, headers=headers)
+
+def entry_response(request, entry):
+    """
+    Response for a cached entry, compressed with the negotiated encoding.
+    Compressed variants are computed once and kept with the entry.
+    """
+    headers = dict(entry["headers"])
+    body = entry["body"]
+    encoding = choose_encoding(request) if len(body) >= COMPRESSION_MIN_SIZE else None
+    if encoding:
+        if encoding not in entry["variants"]:
+            entry["variants"][encoding] = compress_body(body, encoding)
+        body = entry["variants"][encoding]
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type=entry["media_type"], headers=headers)
+
+def cached_response(request, key):
+    """
+    Return 304 if the client already holds the cached response, else the cached response itself.
+    None if the request has to go through the pipeline.
+    """
+    if debug_timings(request):
+        return None  # debug responses always measure the pipeline
+    entry = response_cache.get(key)
+    record_cache_lookup("response", entry is not None)
+    if entry is None:
+        return None
+    if etag_matches(request, entry["headers"]["ETag"]):
+        return Response(status_code=304, headers={
+            name: entry["headers"][name] for name in ("ETag", "Cache-Control", "Vary")
+        })
+    return entry_response(request, entry)
+
+async def tee_into_cache(key, chunks, media_type, headers):
+    body = []
+    size = 0
+    async for chunk in chunks:
+        size += len(chunk)
+        if size <= response_cache.max_body_bytes:
+            body.append(chunk)
+        yield chunk
+    if size <= response_cache.max_body_bytes:
+        response_cache.put(key, {"body": b"".join(body), "media_type": media_type, "headers": headers, "variants": {}})
+
+def cache_response(request, key, response):
+    """
+    Stamp a pipeline response with its ETag and cache version, store its body and compress it for the client.
+    Streamed responses are stored and compressed on the fly while they are sent. Persisted artifacts are only compressed.
+    """
+    if response.status_code != 200 or debug_timings(request):
+        return hold_admission_slot(request, response)
+    if isinstance(response, FileResponse):
+        return compress_response(request, response)
+    headers = {
+        "ETag": make_etag(key),
+        "Cache-Control": RESPONSE_CACHE_CONTROL,
+        "Vary": "Accept-Encoding",
+        "X-Cache-Version": get_cache_version(),
+    }
+    if "content-disposition" in response.headers:
+        headers["Content-Disposition"] = response.headers["content-disposition"]
+
+    if isinstance(response, StreamingResponse):
+        chunks = tee_into_cache(key, response.body_iterator, response.media_type, headers)
+        encoding = choose_encoding(request)
+        if encoding:
+            chunks = compress_stream(chunks, encoding)
+            headers = {**headers, "Content-Encoding": encoding}
+        return hold_admission_slot(request, StreamingResponse(chunks, media_type=response.media_type, headers=headers))
+
+    entry = {"body": response.body, "media_type": response.media_type, "headers": headers, "variants": {}}
+    response_cache.put(key, entry)
+    return entry_response(request, entry)
+
+
+# ======= Spatial index =======
+
+class SpatialIndex:
+    """
+    STRtree over the geometries in geometry_cache.
+    The tree is immutable, so it is rebuilt (vectorized) on the first query after new QIDs have been resolved.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.dirty = True
+        self.generation = 0  # bumped on every rebuild
+        self.tree = None
+        self.qids = np.array([], dtype=object)
+        self.geometries = np.array([], dtype=object)
+
+    def mark_dirty(self):
+        self.dirty = True
+
+    def snapshot(self):
+        import shapely
+        with self.lock:
+            if self.dirty:
+                self.dirty = False
+                entries = [(qid, cached["geometry"]) for qid, cached in geometry_cache.items() if cached["geometry"] is not None]
+                self.qids = np.array([qid for qid, _ in entries], dtype=object)
+                self.geometries = np.array([geometry for _, geometry in entries], dtype=object)
+                self.tree = shapely.STRtree(self.geometries)
+                self.generation += 1
+            return self.tree, self.qids, self.geometries
+
+    def query(self, geometry, predicate="intersects"):
+        tree, qids, _ = self.snapshot()
+        return qids[tree.query(geometry, predicate=predicate)].tolist()
+
+    def nearest(self, point, k=1):
+        """
+        The k nearest QIDs to a point with their distance in degrees.
+        The search radius starts at the nearest geometry and doubles until k candidates are found.
+        """
+        import shapely
+        tree, qids, geometries = self.snapshot()
+        if not len(qids):
+            return []
+        k = min(k, len(qids))
+        radius = max(tree.query_nearest(point, return_distance=True)[1][0], 1e-9)
+        while True:
+            candidates = tree.query(point, predicate="dwithin", distance=radius)
+            if len(candidates) >= k:
+                break
+            radius *= 2
+        distances = shapely.distance(point, geometries[candidates])
+        order = np.argsort(distances)[:k]
+        return [(qids[candidates[i]], float(distances[i])) for i in order]
+
+spatial_index = SpatialIndex()
+
+def cached_entity(qid):
+    """
+    GeoEntity of a place in the spatial index, None if it has been evicted since the index was built.
+    """
+    cached = geometry_cache.get(qid)
+    if cached is None:
+        return None
+    return GeoEntity(cached["label"], qid, "", cached["osm_id"], cached["geometry"])
+
+
+# ======= Vector tiles =======
+
+WEB_MERCATOR_EXTENT = 20037508.342789244  # metres, half the side of the EPSG:3857 square
+TILE_EXTENT = 4096  # tile coordinate space
+TILE_BUFFER = 64  # in tile units, avoids seams at tile edges
+
+def to_web_mercator(coords):
+    lon = np.radians(coords[:, 0])
+    lat = np.radians(np.clip(coords[:, 1], -85.05112878, 85.05112878))
+    return np.column_stack((lon * 6378137.0, np.log(np.tan(np.pi / 4 + lat / 2)) * 6378137.0))
+
+def tile_bounds(z, x, y):
+    """
+    (minx, miny, maxx, maxy) of an XYZ tile in EPSG:3857 metres.
+    """
+    size = 2 * WEB_MERCATOR_EXTENT / 2 ** z
+    minx = -WEB_MERCATOR_EXTENT + x * size
+    maxy = WEB_MERCATOR_EXTENT - y * size
+    return minx, maxy - size, minx + size, maxy
+
+def tile_lon_lat_bounds(z, x, y):
+    n = 2 ** z
+    west, east = x / n * 360 - 180, (x + 1) / n * 360 - 180
+    north = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * y / n))))
+    south = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + 1) / n))))
+    return west, south, east, north
+
+def get_mercator_geometry(cached):
+    """
+    Full geometry of a geometry_cache entry projected to EPSG:3857, computed once and cached with the other levels.
+    """
+    import shapely
+    levels = cached["levels"]
+    if "webmercator" not in levels:
+        levels["webmercator"] = shapely.transform(cached["geometry"], to_web_mercator)
+    return levels["webmercator"]
+
+class ArtifactPlaces:
+    """
+    Places of a persisted artifact loaded from its sidecar, with an STRtree to find the ones in a tile.
+    """
+
+    def __init__(self, path):
+        import shapely
+        self.records = []
+        geometries = []
+        with open(path, "rb") as f:
+            for line in f:
+                record = orjson.loads(line)
+                geometries.append(shapely.from_wkb(base64.b64decode(record.pop("wkb"))))
+                self.records.append(record)
+        self.geometries = np.array(geometries, dtype=object)
+        self.mercator = {}  # index -> geometry in EPSG:3857, projected when first drawn
+        self.tree = shapely.STRtree(self.geometries)
+
+    def query(self, area):
+        import shapely
+        for i in self.tree.query(area):
+            if i not in self.mercator:
+                self.mercator[i] = shapely.transform(self.geometries[i], to_web_mercator)
+            record = self.records[i]
+            yield record["qid"], record["label"], record["osm_id"], self.mercator[i]
+
+ARTIFACT_PLACES_CACHE_SIZE = 16  # artifacts whose places are kept loaded for their tiles
+loaded_artifact_places = OrderedDict()  # artifact id -> ArtifactPlaces, LRU order
+loaded_artifact_places_lock = threading.Lock()
+
+def get_artifact_places(artifact_id):
+    """
+    Places of a persisted artifact, None if it is missing, expired or was persisted without them.
+    """
+    path = artifact_spool.find(artifact_id, "places")
+    if path is None or artifact_spool.find(artifact_id) is None:
+        return None
+    with loaded_artifact_places_lock:
+        places = loaded_artifact_places.get(artifact_id)
+        if places is not None:
+            loaded_artifact_places.move_to_end(artifact_id)
+            return places
+    places = ArtifactPlaces(path)
+    with loaded_artifact_places_lock:
+        loaded_artifact_places[artifact_id] = places
+        while len(loaded_artifact_places) > ARTIFACT_PLACES_CACHE_SIZE:
+            loaded_artifact_places.popitem(last=False)
+    return places
+
+def indexed_places(area):
+    for qid in spatial_index.query(area):
+        cached = geometry_cache.get(qid)
+        if cached is not None:
+            yield qid, cached["label"], cached["osm_id"], get_mercator_geometry(cached)
+
+def render_tile(z, x, y, places=None):
+    """
+    Mapbox Vector Tile with the resolved places intersecting an XYZ tile,
+    clipped to the tile (plus buffer) and simplified to one pixel at this zoom level.
+    Only the places of an artifact are included if given. None if the tile is empty.
+    """
+    import mapbox_vector_tile
+    import shapely
+    bounds = tile_bounds(z, x, y)
+    pixel = (bounds[2] - bounds[0]) / TILE_EXTENT
+    buffer = TILE_BUFFER * pixel
+    clip_bounds = (bounds[0] - buffer, bounds[1] - buffer, bounds[2] + buffer, bounds[3] + buffer)
+
+    area = box(*tile_lon_lat_bounds(z, x, y))
+    features = []
+    for qid, label, osm_id, geometry in (indexed_places(area) if places is None else places.query(area)):
+        geometry = shapely.clip_by_rect(geometry, *clip_bounds)
+        geometry = shapely.simplify(geometry, pixel, preserve_topology=True)
+        if shapely.is_empty(geometry):
+            continue
+        features.append({
+            "id": int(qid[1:]),
+            "geometry": geometry,
+            "properties": {"qid": qid, "label": label, "osm_id": osm_id or ""}
+        })
+
+    if not features:
+        return None
+    return mapbox_vector_tile.encode(
+        [{"name": "features", "features": features}],
+        default_options={"quantize_bounds": bounds, "extents": TILE_EXTENT}
+    )
+
+tile_cache = ResponseCache(TILE_CACHE_SIZE, RESPONSE_CACHE_MAX_BYTES)
+
+
+# ======= Admission control =======
+
+class AdmissionController:
+    """
+    Cap the pipelines running at once, with a bounded queue per endpoint class.
+    A freed slot goes to the queued interactive requests first, bulk jobs never take more than max_bulk slots.
+    It lives on the event loop, so no locking is needed.
+    """
+
+    def __init__(self, max_running, max_bulk, max_queued):
+        self.max_running = max_running
+        self.max_bulk = max_bulk
+        self.max_queued = max_queued  # endpoint class -> queue cap
+        self.running = {"interactive": 0, "bulk": 0}
+        self.waiters = {"interactive": deque(), "bulk": deque()}  # futures resolved when a slot is granted
+        self.durations = {"interactive": deque(maxlen=50), "bulk": deque(maxlen=50)}  # recent run times, for Retry-After
+
+    def can_run(self, endpoint_class):
+        if sum(self.running.values()) >= self.max_running:
+            return False
+        return endpoint_class != "bulk" or self.running["bulk"] < self.max_bulk
+
+    def retry_after(self, endpoint_class):
+        """
+        Seconds until the queue ahead of a new request is likely drained, from the recent run times.
+        """
+        durations = self.durations[endpoint_class]
+        average = sum(durations) / len(durations) if durations else 5.0
+        slots = self.max_bulk if endpoint_class == "bulk" else self.max_running
+        ahead = len(self.waiters["interactive"]) + (len(self.waiters["bulk"]) if endpoint_class == "bulk" else 0)
+        return max(1, math.ceil((ahead / max(slots, 1) + 1) * average))
+
+    async def acquire(self, endpoint_class):
+        waiting = self.waiters[endpoint_class]
+        if not waiting and self.can_run(endpoint_class) and (endpoint_class == "interactive" or not self.waiters["interactive"]):
+            self.running[endpoint_class] += 1
+            return
+        if len(waiting) >= self.max_queued[endpoint_class]:
+            ADMISSION_REJECTED.labels(endpoint_class).inc()
+            raise HTTPException(
+                status_code=429, detail="Too many requests, try again later.",
+                headers={"Retry-After": str(self.retry_after(endpoint_class))}
+            )
+        waiter = asyncio.get_running_loop().create_future()
+        waiting.append(waiter)
+        ADMISSION_QUEUED.labels(endpoint_class).inc()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release(endpoint_class)  # the slot was granted while the client went away
+            else:
+                waiting.remove(waiter)
+            raise
+        finally:
+            ADMISSION_QUEUED.labels(endpoint_class).dec()
+
+    def release(self, endpoint_class, duration=None):
+        self.running[endpoint_class] -= 1
+        if duration is not None:
+            self.durations[endpoint_class].append(duration)
+        for waiting_class in ("interactive", "bulk"):
+            waiting = self.waiters[waiting_class]
+            while waiting and self.can_run(waiting_class):
+                self.running[waiting_class] += 1
+                waiting.popleft().set_result(None)
+
+admission_controller = AdmissionController(
+    MAX_RUNNING_PIPELINES, MAX_RUNNING_BULK,
+    {"interactive": MAX_QUEUED_INTERACTIVE, "bulk": MAX_QUEUED_BULK}
+)
+
+class AdmissionSlot:
+    """
+    Pipeline slot taken by a request. A streamed response takes it over from the dependency,
+    so it is released only once the body, still being built, has been sent.
+    """
+
+    def __init__(self, endpoint_class):
+        self.endpoint_class = endpoint_class
+        self.start = time.perf_counter()
+        self.handed_over = False
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            admission_controller.release(self.endpoint_class, time.perf_counter() - self.start)
+
+class AdmittedStreamingResponse(StreamingResponse):
+    def __init__(self, content, slot, **kwargs):
+        super().__init__(content, **kwargs)
+        self.slot = slot
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.slot.release()  # also when the client goes away
+
+def hold_admission_slot(request, response):
+    """
+    Keep the request's pipeline slot until a streamed response has been sent.
+    """
+    slot = getattr(request.state, "admission_slot", None)
+    if slot is None or not isinstance(response, StreamingResponse):
+        return response
+    slot.handed_over = True
+    headers = {name: value for name, value in response.headers.items() if name != "content-length"}
+    return AdmittedStreamingResponse(response.body_iterator, slot, status_code=response.status_code, headers=headers, media_type=response.media_type)
+
+class CachedResponse(Exception):
+    """
+    Raised by the admission dependency when the response cache already answers the request.
+    """
+
+    def __init__(self, response):
+        self.response = response
+
+@app.exception_handler(CachedResponse)
+async def cached_response_handler(request: Request, exc: CachedResponse):
+    return exc.response
+
+def json_cache_payload(model):
+    """
+    Cache payload of a JSON body: the validated model with sorted keys.
+    None if the body is not valid, FastAPI answers 422 before the endpoint runs.
+    """
+    async def payload(request):
+        try:
+            data = model.model_validate_json(await request.body())
+        except ValueError:
+            return None
+        return orjson.dumps(data.model_dump(), option=orjson.OPT_SORT_KEYS)
+    return payload
+
+async def upload_cache_payload(request):
+    """
+    Cache payload of a multipart upload: the content of its file, rewound for the endpoint.
+    """
+    upload = (await request.form()).get("file")
+    if isinstance(upload, str) or upload is None:
+        return None
+    content = await upload.read()
+    await upload.seek(0)
+    return content
+
+async def query_cache_payload(request):
+    return b""  # the whole input is in the query parameters
+
+def admission(endpoint_class, cache_payload=None):
+    """
+    Dependency holding a pipeline slot of the given class while the endpoint runs (and its streamed response is sent),
+    and setting the tenant its upstream calls are scheduled for.
+    With a cache payload, the response cache is looked up first: hits and 304s never wait for a slot.
+    The key is left in request.state.response_cache_key for the endpoint.
+    """
+    async def admit(request: Request):
+        if cache_payload is not None:
+            payload = await cache_payload(request)
+            if payload is not None:
+                key = response_cache_key(request, payload)
+                request.state.response_cache_key = key
+                cached = await run_in_threadpool(cached_response, request, key)  # may compress the entry
+                if cached is not None:
+                    raise CachedResponse(cached)
+        tenant = request.headers.get("X-Tenant-ID") or correlation_id.get()
+        upstream_tenant.set((tenant, INTERACTIVE_UPSTREAM_WEIGHT if endpoint_class == "interactive" else 1))
+        await admission_controller.acquire(endpoint_class)
+        slot = AdmissionSlot(endpoint_class)
+        request.state.admission_slot = slot
+        try:
+            yield
+        finally:
+            if not slot.handed_over:
+                slot.release()
+    return admit
+
+
+# ======= Admin =======
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """
+    The admin endpoints do not exist unless ADMIN_TOKEN is set, and need it in the X-Admin-Token header.
+    """
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid admin token.")
+
+class SamplingProfiler:
+    """
+    Sample the stack of every thread at a fixed interval from a background thread (sys._current_frames),
+    counting them as folded stacks, the input format of flamegraph.pl and speedscope.
+    """
+
+    def __init__(self):
+        self.thread = None
+        self.stopped = threading.Event()
+        self.stacks = {}  # "thread;file:function;..." -> samples
+        self.samples = 0
+        self.started_at = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, interval):
+        self.stacks = {}
+        self.samples = 0
+        self.started_at = time.time()
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, args=(interval,), name="sampling-profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self, interval):
+        own_id = threading.get_ident()
+        while not self.stopped.wait(interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def folded(self):
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items(), key=itemgetter(1), reverse=True))
+
+profiler = SamplingProfiler()
+tracemalloc_snapshots = OrderedDict()  # snapshot id -> tracemalloc.Snapshot, the oldest are dropped
+
+def allocation_stats(stats, limit):
+    return [
+        {
+            "location": str(stat.traceback),
+            "size_kib": round(stat.size / 1024, 1),
+            "count": stat.count,
+            **({"size_diff_kib": round(stat.size_diff / 1024, 1), "count_diff": stat.count_diff} if hasattr(stat, "size_diff") else {}),
+        }
+        for stat in stats[:limit]
+    ]
+
+def filter_snapshot(snapshot, filename):
+    import tracemalloc
+    if filename:
+        return snapshot.filter_traces([tracemalloc.Filter(True, filename)])
+    return snapshot
+
+
 # ======= FastAPI endpoints =======
 
-@app.post("/geosparql")
-def analyze_from_input(data: TextInput, download: bool = True):
+@app.middleware("http")
+async def track_in_flight(request: Request, call_next):
+    """
+    Count the pipeline requests (the POST endpoints) being processed.
+    """
+    if request.method != "POST" or request.url.path not in pipeline_paths:
+        return await call_next(request)
+    in_flight = IN_FLIGHT.labels(request.url.path)
+    in_flight.inc()
+    try:
+        return await call_next(request)
+    finally:
+        in_flight.dec()
+
+@app.middleware("http")
+async def server_timing(request: Request, call_next):
+    """
+    Collect the timings of the request into a Server-Timing header.
+    With ?debug=timings they are also added to JSON bodies, under "debug".
+    """
+    timings = RequestTimings()
+    request_timings.set(timings)
+    response = await call_next(request)
+    if debug_timings(request) and response.headers.get("content-type", "").startswith(("application/json", "application/ld+json")):
+        body = b"".join([chunk async for chunk in response.body_iterator])
+        document = orjson.loads(body)
+        if isinstance(document, dict):
+            document["debug"] = {"timings": timings.as_dict()}
+            body = orjson.dumps(document)
+        headers = {name: value for name, value in response.headers.items() if name != "content-length"}
+        response = Response(content=body, status_code=response.status_code, headers=headers)
+    response.headers["Server-Timing"] = timings.server_timing()
+    return response
+
+@app.middleware("http")
+async def correlate(request: Request, call_next):
+    """
+    Give every request a correlation id (the client's X-Request-ID if sent), logged with each record and returned in X-Request-ID.
+    """
+    request_id = request.headers.get("X-Request-ID") or uuid4().hex
+    correlation_id.set(request_id)
+    response = await call_next(request)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
+@app.get("/metrics")
+def metrics():
+    """
+    Prometheus metrics: stage and upstream latencies, upstream statuses, retries, waits, cache lookups, requests in flight.
+    """
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/context.jsonld", name="geosparql_context")
+def geosparql_context():
+    """
+    GeoSPARQL JSON-LD @context referenced by every response.
+    """
+    return JSONLDResponse(GEOSPARQL_CONTEXT, headers={"Cache-Control": "public, max-age=86400"})
+
+@app.get("/artifacts/{artifact_id}")
+def get_artifact(request: Request, artifact_id: str, download: bool = Query(True, description="If True, return it as an attachment")):
+    """
+    Return a result persisted with ?persist=true, until it expires.
+    """
+    return compress_response(request, artifact_response(artifact_id, download))
+
+
+@app.get("/spatial/bbox")
+def spatial_bbox(request: Request, minx: float, miny: float, maxx: float, maxy: float, detail: str = Query("bbox", description="Level of detail of the returned geometries")):
+    """
+    Resolved places whose geometry intersects a lon/lat bounding box.
+    """
+    if detail not in DETAIL_LEVELS:
+        return JSONResponse(status_code=400, content={"error": not_supported_detail_message})
+    qids = spatial_index.query(box(minx, miny, maxx, maxy))
+    features = (build_feature(entity, detail) for entity in map(cached_entity, qids) if entity is not None)
+    return compress_response(request, geosparql_response(features, request))
+
+@app.get("/spatial/point")
+def spatial_point(request: Request, lon: float, lat: float, detail: str = Query("bbox", description="Level of detail of the returned geometries")):
+    """
+    Resolved places whose geometry contains (or touches) a lon/lat point.
+    """
+    if detail not in DETAIL_LEVELS:
+        return JSONResponse(status_code=400, content={"error": not_supported_detail_message})
+    qids = spatial_index.query(Point(lon, lat))
+    features = (build_feature(entity, detail) for entity in map(cached_entity, qids) if entity is not None)
+    return compress_response(request, geosparql_response(features, request))
+
+@app.get("/spatial/nearest")
+def spatial_nearest(request: Request, lon: float, lat: float, k: int = Query(5, ge=1, le=1000), detail: str = Query("bbox", description="Level of detail of the returned geometries")):
+    """
+    The k resolved places nearest to a lon/lat point, closest first, with their distance in degrees.
+    """
+    if detail not in DETAIL_LEVELS:
+        return JSONResponse(status_code=400, content={"error": not_supported_detail_message})
+    features = []
+    for qid, distance in spatial_index.nearest(Point(lon, lat), k):
+        entity = cached_entity(qid)
+        if entity is None:
+            continue
+        feature = build_feature(entity, detail)
+        feature["distance"] = distance
+        features.append(feature)
+    return compress_response(request, geosparql_response(features, request))
+
+
+@app.get("/tiles/{z}/{x}/{y}.mvt")
+def get_tile(request: Request, z: int, x: int, y: int, artifact: Optional[str] = Query(None, description="Id of a persisted result, to serve only its features")):
+    """
+    Mapbox Vector Tile of the resolved places (layer 'features'), either all of them or the ones of a persisted result.
+    """
+    if not (0 <= z <= 22 and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        return JSONResponse(status_code=400, content={"error": "Tile coordinates out of range."})
+    places = None
+    if artifact is not None:
+        places = get_artifact_places(artifact)
+        if places is None:
+            return JSONResponse(status_code=404, content={"error": "Artifact not found or expired."})
+        key = f"{artifact}/{z}/{x}/{y}@{get_cache_version()}"  # the places of an artifact never change
+    else:
+        spatial_index.snapshot()  # rebuild first, so the key below matches the indexed geometries
+        key = f"*/{z}/{x}/{y}@{get_cache_version()}:{spatial_index.generation}"
+    entry = tile_cache.get(key)
+    record_cache_lookup("tile", entry is not None)
+    if entry is None:
+        tile = render_tile(z, x, y, places)
+        if tile is None:
+            return Response(status_code=204)
+        entry = {"body": tile, "media_type": "application/vnd.mapbox-vector-tile", "headers": {"Vary": "Accept-Encoding"}, "variants": {}}
+        tile_cache.put(key, entry)
+    return entry_response(request, entry)
+
+
+@app.post("/admin/profiler/start", dependencies=[Depends(require_admin)])
+def start_profiler(interval: float = Query(0.01, gt=0, description="Seconds between two samples")):
+    """
+    Start sampling the stacks of all the threads.
+    """
+    if profiler.running:
+        return JSONResponse(status_code=409, content={"error": "The profiler is already running."})
+    profiler.start(interval)
+    return {"status": "running", "interval": interval}
+
+@app.post("/admin/profiler/stop", dependencies=[Depends(require_admin)])
+def stop_profiler():
+    """
+    Stop the profiler and return the folded stacks (one 'frame;frame;... samples' line each), e.g. for flamegraph.pl.
+    """
+    if not profiler.running:
+        return JSONResponse(status_code=409, content={"error": "The profiler is not running."})
+    profiler.stop()
+    return Response(content=profiler.folded(), media_type="text/plain", headers={
+        "X-Profile-Samples": str(profiler.samples),
+        "X-Profile-Seconds": f"{time.time() - profiler.started_at:.1f}",
+    })
+
+@app.post("/admin/tracemalloc/start", dependencies=[Depends(require_admin)])
+def start_tracemalloc(frames: int = Query(10, ge=1, le=100, description="Frames stored per allocation")):
+    """
+    Start tracing the memory allocations.
+    """
+    import tracemalloc
+    if tracemalloc.is_tracing():
+        return JSONResponse(status_code=409, content={"error": "tracemalloc is already tracing."})
+    tracemalloc.start(frames)
+    return {"status": "tracing", "frames": frames}
+
+@app.post("/admin/tracemalloc/snapshot", dependencies=[Depends(require_admin)])
+def take_tracemalloc_snapshot(limit: int = Query(20, ge=1), key_type: str = Query("lineno", description="Group by 'lineno', 'filename' or 'traceback'"), filename: Optional[str] = Query(None, description="Only allocations made in matching files, e.g. '*main.py'")):
+    """
+    Take a snapshot and return its top allocators. Its id can be passed to /admin/tracemalloc/diff.
+    """
+    import tracemalloc
+    if not tracemalloc.is_tracing():
+        return JSONResponse(status_code=409, content={"error": "tracemalloc is not tracing."})
+    if key_type not in ("lineno", "filename", "traceback"):
+        return JSONResponse(status_code=400, content={"error": "key_type must be 'lineno', 'filename' or 'traceback'."})
+    snapshot = tracemalloc.take_snapshot()
+    snapshot_id = uuid4().hex[:8]
+    tracemalloc_snapshots[snapshot_id] = snapshot
+    while len(tracemalloc_snapshots) > TRACEMALLOC_MAX_SNAPSHOTS:
+        tracemalloc_snapshots.popitem(last=False)
+    current, peak = tracemalloc.get_traced_memory()
+    return {
+        "id": snapshot_id,
+        "traced_kib": round(current / 1024, 1),
+        "peak_kib": round(peak / 1024, 1),
+        "top": allocation_stats(filter_snapshot(snapshot, filename).statistics(key_type), limit),
+    }
+
+@app.get("/admin/tracemalloc/diff", dependencies=[Depends(require_admin)])
+def diff_tracemalloc_snapshots(base: str, target: str, limit: int = Query(20, ge=1), key_type: str = Query("lineno", description="Group by 'lineno', 'filename' or 'traceback'"), filename: Optional[str] = Query(None, description="Only allocations made in matching files, e.g. '*main.py'")):
+    """
+    Allocations that grew (or shrank) the most between two snapshots.
+    """
+    if base not in tracemalloc_snapshots or target not in tracemalloc_snapshots:
+        return JSONResponse(status_code=404, content={"error": "Snapshot not found."})
+    if key_type not in ("lineno", "filename", "traceback"):
+        return JSONResponse(status_code=400, content={"error": "key_type must be 'lineno', 'filename' or 'traceback'."})
+    stats = filter_snapshot(tracemalloc_snapshots[target], filename).compare_to(
+        filter_snapshot(tracemalloc_snapshots[base], filename), key_type
+    )
+    return {"base": base, "target": target, "top": allocation_stats(stats, limit)}
+
+@app.post("/admin/tracemalloc/stop", dependencies=[Depends(require_admin)])
+def stop_tracemalloc():
+    """
+    Stop tracing and drop the snapshots.
+    """
+    import tracemalloc
+    tracemalloc.stop()
+    tracemalloc_snapshots.clear()
+    return {"status": "stopped"}
+
+
+@app.post("/geosparql", dependencies=[Depends(admission("interactive", json_cache_payload(TextInput)))])
+def analyze_from_input(request: Request, data: TextInput, download: bool = True, detail: str = "full", output_format: str = Query("jsonld", alias="format", description="Output format: jsonld, geoparquet, flatgeobuf or ndjson"), pretty: bool = Query(False, description="If True, pretty-print the JSON-LD")):
     """
         Return JSON‑LD compliant with GeoSPARQL.
         ?download=false --> JSON inline
@@ -588,51 +2632,62 @@ def analyze_from_input(data: TextInput, download: bool = True):
         lang = data.lang.lower()
         if lang not in SUPPORTED_LANGUAGES:
             return {not_supported_message}
+        if detail not in DETAIL_LEVELS:
+            return JSONResponse(status_code=400, content={"error": not_supported_detail_message})
+        if output_format not in OUTPUT_FORMATS:
+            return JSONResponse(status_code=400, content={"error": not_supported_format_message})
+        cache_key = request.state.response_cache_key
+
         results = analyze_text(data.text, lang=lang)
 
-        features = []
+        resolved = []
         for res in results:
-            if res["vkt"]:
-                feature_id = f"wd:{res['qid']}"
-                geometry_obj = {
-                    "@id": f"{feature_id}-geom",
-                    "@type": "Geometry",
-                    "asWKT": f"SRID=4326;{res['vkt']}"
-                }
-                feature = {
-                    "@id": feature_id,
-                    "@type": "Feature",
-                    "label": res["label"],
-                    "description": res["description"],
-                    "qid": res["qid"],
-                    "wikidata": res["wikidata_url"],
-                    "osm_id": res["osm_id"],
-                    "hasGeometry": geometry_obj
-                }
-                features.append(feature)
+            if res.geometry is not None:
+                resolved.append(res)
 
-        geosparql_doc = {
-            **GEOSPARQL_CONTEXT,
-            "@graph": features
-        }
+        if output_format != "jsonld":
+            return cache_response(request, cache_key, write_output(resolved, output_format, detail, download))
 
-        if not download:
-            return JSONResponse(content=geosparql_doc,
-                                media_type="application/ld+json")
+        features = (build_feature(entity, detail) for entity in resolved)
+        return cache_response(request, cache_key, geosparql_response(features, request, download, pretty))
 
-        filename = f"geosparql_{uuid4().hex}.jsonld"
-        path = f"/tmp/{filename}"
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(geosparql_doc, f, ensure_ascii=False, indent=2)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-        return FileResponse(path, media_type="application/ld+json", filename=filename)
+
+@app.post("/geosparql/batch", dependencies=[Depends(admission("bulk", json_cache_payload(BatchInput)))])
+def analyze_batch(request: Request, data: BatchInput, download: bool = False, detail: str = "full", pretty: bool = Query(False, description="If True, pretty-print the JSON-LD")):
+    """
+    Analyze many texts at once, each with its own language.
+    Every distinct entity is resolved once for the whole batch,
+    documents reference a single Geometry node per place.
+    """
+    try:
+        if not data.documents:
+            return JSONResponse(status_code=400, content={"error": "No documents in the batch."})
+        if len(data.documents) > BATCH_MAX_DOCUMENTS:
+            return JSONResponse(status_code=400, content={"error": f"Too many documents, the limit is {BATCH_MAX_DOCUMENTS}."})
+        langs = [document.lang.lower() for document in data.documents]
+        if any(lang not in SUPPORTED_LANGUAGES for lang in langs):
+            return JSONResponse(status_code=400, content={"error": not_supported_message})
+        if detail not in DETAIL_LEVELS:
+            return JSONResponse(status_code=400, content={"error": not_supported_detail_message})
+        cache_key = request.state.response_cache_key
+
+        context = ResolutionContext()
+        documents = []
+        for document, lang in zip(data.documents, langs):
+            results = analyze_text(document.text, lang=lang, context=context)
+            documents.append((lang, [res for res in results if res.geometry is not None]))
+
+        return cache_response(request, cache_key, geosparql_response(batch_graph(documents, detail), request, download, pretty))
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/analyze-from-xml")
-async def analyze_from_xml(file: UploadFile = File(...), lang: Optional[str] = "en", download: bool = True):
+@app.post("/analyze-from-xml", dependencies=[Depends(admission("bulk", upload_cache_payload))])
+def analyze_from_xml(request: Request, file: UploadFile = File(...), lang: Optional[str] = "en", download: bool = True, detail: str = "full", output_format: str = Query("jsonld", alias="format", description="Output format: jsonld, geoparquet, flatgeobuf or ndjson"), pretty: bool = Query(False, description="If True, pretty-print the JSON-LD"), persist: bool = Query(False, description="If True, keep the result as an artifact served by /artifacts/{id}")):
     """
     Parse an uploaded XML file,
     extract text from a specific node,
@@ -642,8 +2697,13 @@ async def analyze_from_xml(file: UploadFile = File(...), lang: Optional[str] = "
         lang = lang.lower()
         if lang not in SUPPORTED_LANGUAGES:
             return JSONResponse(status_code=400, content={"error": not_supported_message})
+        if detail not in DETAIL_LEVELS:
+            return JSONResponse(status_code=400, content={"error": not_supported_detail_message})
+        if output_format not in OUTPUT_FORMATS:
+            return JSONResponse(status_code=400, content={"error": not_supported_format_message})
 
-        content = await file.read()
+        content = file.file.read()
+        cache_key = request.state.response_cache_key
         tree = ET.ElementTree(ET.fromstring(content))
         root = tree.getroot()
 
@@ -661,57 +2721,34 @@ async def analyze_from_xml(file: UploadFile = File(...), lang: Optional[str] = "
         #results = analyze_text(full_text, lang=lang)
         #return {"results": results}
 
-        features = []
-        for literal in literals:
+        # one feature per QID, the literals mentioning it are listed as Mention records
+        context = ResolutionContext()
+        resolved = {}
+        mentions = []
+        for index, literal in enumerate(literals):
             text = literal.text.strip() if literal.text else ""
             if text:
-                results = analyze_text(text, lang=lang)
+                results = analyze_text(text, lang=lang, context=context)
                 for res in results:
-                    if res["vkt"]:
-                        feature_id = f"wd:{res['qid']}"
-                        geometry_obj = {
-                            "@id": f"{feature_id}-geom",
-                            "@type": "Geometry",
-                            "asWKT": f"SRID=4326;{res['vkt']}"
-                        }
-                        feature = {
-                            "@id": feature_id,
-                            "@type": "Feature",
-                            "label": res["label"],
-                            "description": res["description"],
-                            "qid": res["qid"],
-                            "wikidata": res["wikidata_url"],
-                            "osm_id": res["osm_id"],
-                            "hasGeometry": geometry_obj,
-                            "source_text": text
-                        }
-                        features.append(feature)
+                    if res.geometry is not None:
+                        resolved.setdefault(res.qid, res)
+                        mentions.extend(build_mentions(res, index))
             else:
-                print("Missing text for literal", literal)
-
-        geosparql_doc = {
-            **GEOSPARQL_CONTEXT,
-            "@graph": features
-        }
+                xml_logger.warning("Missing text for literal", extra={"literal": index})
 
-        if not download:
-            return JSONResponse(content=geosparql_doc,
-                                media_type="application/ld+json")
+        if output_format != "jsonld":
+            return cache_response(request, cache_key, write_output(list(resolved.values()), output_format, detail, download, persist))
 
-        filename = f"geosparql_{uuid4().hex}.jsonld"
-        path = f"/tmp/{filename}"
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(geosparql_doc, f, ensure_ascii=False, indent=2)
-
-        return FileResponse(path, media_type="application/ld+json", filename=filename)
+        features = chain((build_feature(entity, detail) for entity in resolved.values()), mentions)
+        return cache_response(request, cache_key, geosparql_response(features, request, download, pretty, persist))
 
     except ET.ParseError:
         raise HTTPException(status_code=400, detail="XML file not valid.")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/analyze-from-iri")
-async def analyze_geonames_iri(iri: str = Query(..., description="IRI from Geonames (e.g. https://www.geonames.org/2618425/denmark.html)"), lang: str = Query("en", description="Analysis language"), download: bool = Query(False, description="If True, return a downloadable .jsonld")):
+@app.post("/analyze-from-iri", dependencies=[Depends(admission("interactive", query_cache_payload))])
+def analyze_geonames_iri(request: Request, iri: str = Query(..., description="IRI from Geonames (e.g. https://www.geonames.org/2618425/denmark.html)"), lang: str = Query("en", description="Analysis language"), download: bool = Query(False, description="If True, return a downloadable .jsonld"), detail: str = Query("full", description="Level of detail of the geometries: full, medium, low, bbox or centroid"), output_format: str = Query("jsonld", alias="format", description="Output format: jsonld, geoparquet, flatgeobuf or ndjson"), pretty: bool = Query(False, description="If True, pretty-print the JSON-LD")):
     """
     Analyze a GeoNames data page using IRI.
     Extract the main content and apply the geographic disambiguation process.
@@ -720,6 +2757,12 @@ async def analyze_geonames_iri(iri: str = Query(..., description="IRI from Geona
         lang = lang.lower()
         if lang not in SUPPORTED_LANGUAGES:
             return JSONResponse(status_code=400, content={"error": not_supported_message})
+        if detail not in DETAIL_LEVELS:
+            return JSONResponse(status_code=400, content={"error": not_supported_detail_message})
+        if output_format not in OUTPUT_FORMATS:
+            return JSONResponse(status_code=400, content={"error": not_supported_format_message})
+
+        cache_key = request.state.response_cache_key
 
         match = re.search(r'/(\d+)/', iri)
         if not match:
@@ -747,53 +2790,32 @@ async def analyze_geonames_iri(iri: str = Query(..., description="IRI from Geona
 
         results = analyze_text(label, lang=lang)
 
-        features = []
+        resolved = []
         for res in results:
-            if res["vkt"]:
-                feature_id = f"wd:{res['qid']}"
-                geometry_obj = {
-                    "@id": f"{feature_id}-geom",
-                    "@type": "Geometry",
-                    "asWKT": f"SRID=4326;{res['vkt']}"
-                }
-                feature = {
-                    "@id": feature_id,
-                    "@type": "Feature",
-                    "label": res["label"],
-                    "description": res["description"],
-                    "qid": res["qid"],
-                    "wikidata": res["wikidata_url"],
-                    "osm_id": res["osm_id"],
-                    "hasGeometry": geometry_obj
-                }
-                features.append(feature)
+            if res.geometry is not None:
+                resolved.append(res)
             else:
-                print("Missing text for ", res)
-
-        geosparql_doc = {
-            **GEOSPARQL_CONTEXT,
-            "@graph": features
-        }
+                logger.warning("Missing geometry", extra={"qid": res.qid, "label": res.label})
 
-        if not download:
-            return JSONResponse(content=geosparql_doc,
-                                media_type="application/ld+json")
+        if output_format != "jsonld":
+            return cache_response(request, cache_key, write_output(resolved, output_format, detail, download))
 
-        filename = f"geosparql_{uuid4().hex}.jsonld"
-        path = f"/tmp/{filename}"
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(geosparql_doc, f, ensure_ascii=False, indent=2)
-
-        return FileResponse(path, media_type="application/ld+json", filename=filename)
+        features = (build_feature(entity, detail) for entity in resolved)
+        return cache_response(request, cache_key, geosparql_response(features, request, download, pretty))
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/analyze-from-csv")
-async def analyze_geonames_csv(
+@app.post("/analyze-from-csv", dependencies=[Depends(admission("bulk", upload_cache_payload))])
+def analyze_geonames_csv(
+    request: Request,
     file: UploadFile = File(..., description="CSV file with a 'geonames' column containing GeoNames IRIs"),
     #lang: str = Query("en", description="Analysis language"),
-    download: bool = Query(False, description="If True, return a downloadable .jsonld")
+    download: bool = Query(False, description="If True, return a downloadable .jsonld"),
+    detail: str = Query("full", description="Level of detail of the geometries: full, medium, low, bbox or centroid"),
+    output_format: str = Query("jsonld", alias="format", description="Output format: jsonld, geoparquet, flatgeobuf or ndjson"),
+    pretty: bool = Query(False, description="If True, pretty-print the JSON-LD"),
+    persist: bool = Query(False, description="If True, keep the result as an artifact served by /artifacts/{id}")
 ):
     """
     Analyze a CSV file containing GeoNames IRIs in the 'geonames' column.
@@ -804,29 +2826,36 @@ async def analyze_geonames_csv(
         #if lang not in SUPPORTED_LANGUAGES:
         #    return JSONResponse(status_code=400, content={"error": not_supported_message})
 
-        content = await file.read()
+        if detail not in DETAIL_LEVELS:
+            return JSONResponse(status_code=400, content={"error": not_supported_detail_message})
+        if output_format not in OUTPUT_FORMATS:
+            return JSONResponse(status_code=400, content={"error": not_supported_format_message})
+
+        content = file.file.read()
+        cache_key = request.state.response_cache_key
         df = pd.read_csv(pd.io.common.BytesIO(content))
 
         if "geonames" not in df.columns:
             return JSONResponse(status_code=400, content={"error": "Missing 'geonames' column in CSV."})
 
-        features = []
+        resolved = []
 
         processed_geonames_id = set()
         processed_qids = set()
+        context = ResolutionContext()
 
         for iri in df["geonames"].dropna().unique():
             entities = []
 
             match = re.search(r'/(\d+)', iri)
             if not match:
-                logger.warning(f"\n⚠️ Skipping {iri}, it is not a valid GeoNames IRI format.")
+                csv_logger.warning("Skipping IRI, it is not a valid GeoNames IRI", extra={"iri": iri})
                 continue  # skip invalid IRI
 
             geonames_id = match.group(1)
 
             if geonames_id in processed_geonames_id:
-                logger.warning(f"\n⚠️ Skipping '{iri}', already processed.")
+                csv_logger.info("Skipping IRI, already processed", extra={"iri": iri, "sampled": True})
                 continue    # skip IRI already processed
 
             # TODO
@@ -857,39 +2886,22 @@ async def analyze_geonames_csv(
                         qid = wikidata_entity["id"]
 
                         if qid in processed_qids:
-                            logger.warning(f"\n⚠️ Skipping '{iri}', already processed.")
+                            csv_logger.info("Skipping IRI, already processed", extra={"iri": iri, "sampled": True})
                             continue
 
                         geometry = retrieve_geometry(None, label, qid, entities, processed_qids, True)
 
                         if geometry:
                             for g in geometry:
-                                if g["vkt"]:
-                                    feature_id = f"wd:{g['qid']}"
-                                    geometry_obj = {
-                                        "@id": f"{feature_id}-geom",
-                                        "@type": "Geometry",
-                                        "asWKT": f"SRID=4326;{g['vkt']}"
-                                    }
-                                    feature = {
-                                        "@id": feature_id,
-                                        "@type": "Feature",
-                                        "label": g["label"],
-                                        "description": g["description"],
-                                        "qid": g["qid"],
-                                        "wikidata": g["wikidata_url"],
-                                        "osm_id": g["osm_id"],
-                                        "hasGeometry": geometry_obj
-                                    }
-
-                                    features.append(feature)
+                                if g.geometry is not None:
+                                    resolved.append(g)
                                     processed_geonames_id.add(geonames_id)
 
                                 else:
-                                    logger.warning(f"\n⚠️ Missing geometry for '{g['label']}', Wikidata URL: {g['wikidata_url']}. Skipping '{iri}'.")
+                                    csv_logger.warning("Skipping IRI, missing geometry", extra={"iri": iri, "qid": g.qid, "label": g.label})
                                     continue
                         else:
-                            logger.warning(f"\n⚠️ Missing geometry for '{iri}'. Skipping...")
+                            csv_logger.warning("Skipping IRI, missing geometry", extra={"iri": iri})
                             continue
 
                     else:
@@ -908,93 +2920,59 @@ async def analyze_geonames_csv(
                             if "_" in title:
                                 title = title.replace("_", " ")
 
-                            annotations = disambiguation_with_wikifier(title)
-                            analyze(annotations, entities, processed_qids)
+                            annotations = context.annotate(title)
+                            analyze(annotations, entities, processed_qids, context)
 
                             if not entities:
 
                                 entity = search_wikidata_entity(title)
 
                                 if not entity:
-                                    logger.warning(f"\n⚠️ Skipping '{iri}', no results found.")
+                                    csv_logger.warning("Skipping IRI, no results found", extra={"iri": iri})
                                     continue
 
                                 label = entity["label"]
                                 qid = entity["id"]
 
                                 if qid in processed_qids:
-                                    logger.warning(f"\n⚠️ Skipping '{iri}', already processed.")
+                                    csv_logger.info("Skipping IRI, already processed", extra={"iri": iri, "sampled": True})
                                     continue
 
                                 geometry = retrieve_geometry(None, label, qid, entities, processed_qids, True)
 
                                 if geometry:
                                     for g in geometry:
-                                        if g["vkt"]:
-                                            feature_id = f"wd:{g['qid']}"
-                                            geometry_obj = {
-                                                "@id": f"{feature_id}-geom",
-                                                "@type": "Geometry",
-                                                "asWKT": f"SRID=4326;{g['vkt']}"
-                                            }
-                                            feature = {
-                                                "@id": feature_id,
-                                                "@type": "Feature",
-                                                "label": g["label"],
-                                                "description": g["description"],
-                                                "qid": g["qid"],
-                                                "wikidata": g["wikidata_url"],
-                                                "osm_id": g["osm_id"],
-                                                "hasGeometry": geometry_obj
-                                            }
-
-                                            features.append(feature)
+                                        if g.geometry is not None:
+                                            resolved.append(g)
                                             processed_geonames_id.add(geonames_id)
 
                                         else:
-                                            logger.warning(
-                                                f"\n⚠️ Missing geometry for '{g['label']}', Wikidata URL: {g['wikidata_url']}. Skipping '{iri}'.")
+                                            csv_logger.warning("Skipping IRI, missing geometry", extra={"iri": iri, "qid": g.qid, "label": g.label})
                                             continue
                                 else:
-                                    logger.warning(f"\n⚠️ Missing geometry for '{iri}'. Skipping...")
+                                    csv_logger.warning("Skipping IRI, missing geometry", extra={"iri": iri})
                                     continue
 
                                 continue
 
                             for e in entities:
-                                if e["vkt"]:
-                                    feature_id = f"wd:{e['qid']}"
-                                    geometry_obj = {
-                                        "@id": f"{feature_id}-geom",
-                                        "@type": "Geometry",
-                                        "asWKT": f"SRID=4326;{e['vkt']}"
-                                    }
-                                    feature = {
-                                        "@id": feature_id,
-                                        "@type": "Feature",
-                                        "label": e["label"],
-                                        "description": e["description"],
-                                        "qid": e["qid"],
-                                        "wikidata": e["wikidata_url"],
-                                        "osm_id": e["osm_id"],
-                                        "hasGeometry": geometry_obj
-                                    }
-                                    features.append(feature)
+                                if e.geometry is not None:
+                                    resolved.append(e)
                                     processed_geonames_id.add(geonames_id)
 
                                 else:
-                                    logger.warning(f"\n⚠️ Missing geometry for '{e['label']}, Wikidata URL: {e['wikidata_url']}'. Skipping '{iri}'.")
+                                    csv_logger.warning("Skipping IRI, missing geometry", extra={"iri": iri, "qid": e.qid, "label": e.label})
                                     continue
 
                             continue
 
                         else:
-                            logger.warning(f"\n⚠️ Title is '{title}'. Skipping '{iri}'. Info: {wikipedia_url, wikidata_entity}.")
+                            csv_logger.warning("Skipping IRI, no title", extra={"iri": iri, "title": title, "wikipedia_url": wikipedia_url, "wikidata_entity": wikidata_entity})
                             continue
 
 
                 except WikipediaRateLimitException as e:
-                    logger.warning(f"\n⚠️ Wikipedia rate limit exceeded: {e}. Skipping '{iri}'.")
+                    csv_logger.warning("Skipping IRI, Wikipedia rate limit exceeded", extra={"iri": iri, "error": str(e)})
                     continue
 
             else:
@@ -1005,66 +2983,44 @@ async def analyze_geonames_csv(
                 match_id = re.search(r"wikidata\.org/entity/(Q\d+)", url)
                 qid = match_id.group(1)
                 if not qid:
-                    logger.warning(f"\n⚠️ Skipping '{iri}', qid not found.")
+                    csv_logger.warning("Skipping IRI, QID not found", extra={"iri": iri})
                     continue
                 if not label:
-                    logger.warning(f"\n⚠️ Skipping '{iri}', label not found.")
+                    csv_logger.warning("Skipping IRI, label not found", extra={"iri": iri})
                     continue
 
                 if qid in processed_qids:
-                    logger.warning(f"\n⚠️ Skipping '{iri}', already processed.")
+                    csv_logger.info("Skipping IRI, already processed", extra={"iri": iri, "sampled": True})
                     continue
 
                 geometry = retrieve_geometry(None, label, qid, entities, processed_qids, True)
 
                 if geometry:
                     for g in geometry:
-                        if g["vkt"]:
-                            feature_id = f"wd:{g['qid']}"
-                            geometry_obj = {
-                                "@id": f"{feature_id}-geom",
-                                "@type": "Geometry",
-                                "asWKT": f"SRID=4326;{g['vkt']}"
-                            }
-                            feature = {
-                                "@id": feature_id,
-                                "@type": "Feature",
-                                "label": g["label"],
-                                "description": g["description"],
-                                "qid": g["qid"],
-                                "wikidata": g["wikidata_url"],
-                                "osm_id": g["osm_id"],
-                                "hasGeometry": geometry_obj
-                            }
-
-                            features.append(feature)
+                        if g.geometry is not None:
+                            resolved.append(g)
                             processed_geonames_id.add(geonames_id)
 
                         else:
-                            logger.warning(f"\n⚠️ Missing geometry for '{g['label']}', Wikidata URL: {g['wikidata_url']}. Skipping '{iri}'.")
+                            csv_logger.warning("Skipping IRI, missing geometry", extra={"iri": iri, "qid": g.qid, "label": g.label})
                             continue
                 else:
-                    logger.warning(f"\n⚠️ Missing geometry for '{iri}'. Skipping...")
+                    csv_logger.warning("Skipping IRI, missing geometry", extra={"iri": iri})
                     continue
 
-        geosparql_doc = {
-            **GEOSPARQL_CONTEXT,
-            "@graph": features
-        }
-
-        if not download:
-            return JSONResponse(content=geosparql_doc,
-                                media_type="application/ld+json")
-
-        filename = f"geosparql_{uuid4().hex}.jsonld"
-        path = f"/tmp/{filename}"
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(geosparql_doc, f, ensure_ascii=False, indent=2)
+        if output_format != "jsonld":
+            return cache_response(request, cache_key, write_output(resolved, output_format, detail, download, persist))
 
-        return FileResponse(path, media_type="application/ld+json", filename=filename)
+        features = (build_feature(entity, detail) for entity in resolved)
+        return cache_response(request, cache_key, geosparql_response(features, request, download, pretty, persist))
 
     except Exception as e:
         tb = traceback.extract_tb(sys.exc_info()[2])
         filename, lineno, func, text = tb[-1]  # last call in stack
         error_message = f"{str(e)} (File \"{filename}\", line {lineno}, in {func}: {text})"
-        raise HTTPException(status_code=500, detail=error_message)
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=error_message)
+
+pipeline_paths = {  # tracked by track_in_flight
+    route.path for route in app.routes
+    if "POST" in getattr(route, "methods", ()) and not route.path.startswith("/admin/")
+}
\ No newline at end of file